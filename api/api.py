@@ -1,16 +1,25 @@
 from datetime import datetime
-from psycopg2 import sql
+from psycopg.errors import QueryCanceled
+from psycopg_pool import PoolTimeout, TooManyRequests
+from os import getpid
+from re import compile as compile_regex
+import orjson
 from fastapi import FastAPI
-from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from api_tools import query_database, generate_query, serve_csv, verify_input
+from api_tools import (query_database, generate_query, serve_csv, verify_input,
+                       serve_export, to_columns, encode_cursor, decode_cursor, estimate_rows,
+                       estimate_cost, typed_query, EXPORT_FORMATS, PAGE_SIZE, MAX_JSON_ROWS, HEAVY_QUERY_ROWS,
+                       open_connection_pool, close_connection_pool, pool_stats, data_version,
+                       load_aws_catalog, load_realtime_snapshot, snapshot_row,
+                       REALTIME_VARIABLES, REALTIME_WINDOWS)
+from cache import make_key, get_response, put_response
+import metrics
+from metrics import ORJSONResponse
 
 ## Define a FastAPI application which accepts all incoming requests
 ## and mount a publicly accessible /static directory for static content
-## TODO remove years endpoint + from list: too slow
-## Don't do the lookup table, makes everything too complicated
-## Realtime should have Current, Daily, Weekly, Monthly max/min searches
 
 app = FastAPI()
 app.add_middleware(
@@ -20,130 +29,220 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.add_middleware(metrics.MetricsMiddleware)
+
+## Static files are revalidated on every use (StaticFiles answers If-None-Match and
+## If-Modified-Since with 304), except content-hashed GIF/WebP animations published
+## by make_gifs.py, whose contents never change under a given name
+HASHED_STATIC_FILE = compile_regex(r"\.[0-9a-f]{12}\.(gif|webp)$")
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"\
+            if HASHED_STATIC_FILE.search(str(full_path)) else "no-cache"
+        return response
+
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+
+@app.on_event("startup")
+async def startup() -> None:
+    await open_connection_pool()
+    await load_aws_catalog()
+    await load_realtime_snapshot()
+    metrics.start_flushing()
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await close_connection_pool()
+
+## Answer to a query cancelled by its statement_timeout (see api_tools.QUERY_TIMEOUT)
+QUERY_CANCELED_ERROR = "Query took too long. Use fewer stations, a shorter date range or download=True"
+
+## A request that cannot get a database connection in time (or finds too many
+## requests already queued) is answered 503 rather than 500, so clients can retry
+@app.exception_handler(PoolTimeout)
+@app.exception_handler(TooManyRequests)
+async def pool_exhausted_handler(request, error) -> ORJSONResponse:
+    return ORJSONResponse({'error': "The API is busy, please retry shortly"}, status_code=503,
+                          headers={"Retry-After": "5"})
 
 @app.get("/test", response_class=ORJSONResponse)
-def test_app() -> ORJSONResponse:
+async def test_app() -> ORJSONResponse:
     now = datetime.now()
     return ORJSONResponse(content={f'{now}' : 'AMRDC Data API is online'})
 
+@app.get("/test/pool", response_class=ORJSONResponse)
+async def pool_stats_endpoint() -> ORJSONResponse:
+    ## Connection pool gauges of the worker answering the request
+    return ORJSONResponse(content={"pid": getpid(), **pool_stats()})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> PlainTextResponse:
+    ## Request latency, phase, row and byte metrics of all workers (Prometheus text format)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/gifs", response_class=ORJSONResponse)
+async def gif_manifest_endpoint() -> ORJSONResponse:
+    ## Current content-hashed satellite animations per channel (see make_gifs.py)
+    try:
+        with open("static/gifs.json", "rb") as manifest:
+            content = orjson.loads(manifest.read())
+    except FileNotFoundError:
+        content = {}
+    return ORJSONResponse(content=content, headers={"Cache-Control": "no-cache"})
+
                         #######################
                         #### API ENDPOINTS ####
                         #######################
 ################################################################################
 ## Each of the following functions exposes an HTTP-accessible API endpoint to ##
-## execute a SQL query and return data via JSON. We are using psycopg2 to     ##
+## execute a SQL query and return data via JSON. We are using psycopg 3 to    ##
 ## generate queries and access Postgres. The client db user is  READ-ONLY.    ##
 ################################################################################
                 ###########################################
                 ###  REALTIME AWS DATA  : `/realtime`   ###
                 ###########################################
 
+## Realtime endpoints are answered from the in-memory realtime snapshot
+
 @app.get("/realtime/maxmin/{variable}", response_class=ORJSONResponse)
-def current_maxmin_endpoint(variable: str) -> ORJSONResponse:
-    max_q = sql.SQL("""SELECT station_name, TO_CHAR(date, 'YYYY-MM-DD'), TO_CHAR(time, 'HH24:MI:SS'), {}
-                       FROM aws_realtime
-                       ORDER BY {} DESC LIMIT 1""",).format(sql.Identifier(variable),
-                                                            sql.Identifier(variable))
-    min_q = sql.SQL("""SELECT station_name, TO_CHAR(date, 'YYYY-MM-DD'), TO_CHAR(time, 'HH24:MI:SS'), {}
-                       FROM aws_realtime
-                       ORDER BY {} ASC LIMIT 1""",).format(sql.Identifier(variable),
-                                                           sql.Identifier(variable))
-    data = {
-        "max": query_database(max_q)["data"],
-        "min": query_database(min_q)["data"], 
-    }
+async def current_maxmin_endpoint(variable: str, window: str = "current") -> ORJSONResponse:
+    ## Max/min across all stations over the realtime data ("current") or the latest
+    ## calendar day, week or month
+    if variable not in REALTIME_VARIABLES:
+        return ORJSONResponse({'error': f"Invalid variable. Options: {', '.join(REALTIME_VARIABLES)}"})
+    if window not in REALTIME_WINDOWS:
+        return ORJSONResponse({'error': f"Invalid window. Options: {', '.join(REALTIME_WINDOWS)}"})
+    snapshot = await load_realtime_snapshot()
+    data = {extreme: [row] if row is not None else []
+            for extreme, row in snapshot["extremes"][window][variable].items()}
     return ORJSONResponse(content=data)
 
 
 @app.get("/realtime/station_list", response_class=ORJSONResponse)
-def station_list_endpoint() -> ORJSONResponse:
-    query = """SELECT DISTINCT(station_name), region
-               FROM aws_realtime ORDER BY region, station_name"""
-    query_results = query_database(query)["data"]
-    station_dict = {}
-    for station, region in query_results:
-        station_dict.setdefault(region, []).append(station)
-    return ORJSONResponse(content=station_dict)
-
-
-@app.get("/realtime/station/{station}", response_class=ORJSONResponse)
-def current_station_data_endpoint(station: str) -> ORJSONResponse:
-    query = """SELECT station_name, TO_CHAR(date, 'YYYY-MM-DD') as date,
-                TO_CHAR(time, 'HH24:MI:SS') as time, temperature, pressure,
-                wind_speed, wind_direction, humidity
-                FROM aws_realtime
-                WHERE station_name = %s ORDER BY date DESC, time DESC LIMIT 1"""
-    query_results = query_database(query, (station,))["data"]
-    return ORJSONResponse(content=query_results)
-
-
-##@app.get("/realtime/daily-maxmin/{variable}", response_class=ORJSONResponse)
-##def daily_maxmin_endpoint(variable: str = None) -> ORJSONResponse:
-##    query = ("""SELECT station_name, TO_CHAR(date, 'YYYY-MM-DD'), TO_CHAR(time, 'HH24:MI:SS'),
-##                variable, datapoint
-##                FROM aws_realtime_aggregate
-##                WHERE variable=%s ORDER BY variable DESC""", (variable,))
-##    query_results = query_database(query[0], query[1])["data"]
-##    maximum, minimum = query_results
-##    daily_aggregates = {"max":maximum,"min":minimum}
-##    return ORJSONResponse(content=daily_aggregates)
+async def station_list_endpoint() -> ORJSONResponse:
+    snapshot = await load_realtime_snapshot()
+    return ORJSONResponse(content=snapshot["regions"])
+
+
+@app.get("/realtime/station/{stations}", response_class=ORJSONResponse)
+async def current_station_data_endpoint(stations: str, region: str = None) -> ORJSONResponse:
+    ## Latest datapoint for a comma-separated list of stations, or "all" stations
+    ## (ordered by region), optionally restricted to one region
+    snapshot = await load_realtime_snapshot()
+    fields = ("station_name", "date", "time") + REALTIME_VARIABLES
+    if stations == "all":
+        station_list = [station for region_stations in snapshot["regions"].values()
+                        for station in region_stations]
+    else:
+        station_list = dict.fromkeys(station.replace('%20', ' ') for station in stations.split(','))
+    indexes = (snapshot["latest"].get(station) for station in station_list)
+    data = [snapshot_row(snapshot, index, fields) for index in indexes
+            if index is not None and (region is None or snapshot["columns"]["region"][index] == region)]
+    return ORJSONResponse(content=data)
+
+
+@app.get("/realtime/daily-maxmin/{variable}", response_class=ORJSONResponse)
+async def daily_maxmin_endpoint(variable: str) -> ORJSONResponse:
+    return await current_maxmin_endpoint(variable, window="day")
 
                 #######################################
                 ###  HISTORICAL AWS DATA  : `/aws`  ###
                 #######################################
 
+## The list endpoints are answered from the in-memory station/year catalog
 @app.get("/aws/list", response_class=ORJSONResponse)
-def list_stations_and_years_endpoint() -> ORJSONResponse:
-    stations_list_query = "SELECT DISTINCT(station_name) FROM aws_10min ORDER BY station_name"
-    years_list_query = "SELECT * FROM aws_10min_years ORDER BY date"
-    stations = query_database(stations_list_query)
-    years = query_database(years_list_query)
+async def list_stations_and_years_endpoint() -> ORJSONResponse:
+    catalog = await load_aws_catalog()
     data = {
-        "stations": stations["data"],
-        "years": years["data"]
+        "stations": [[station] for station in sorted(catalog)],
+        "years": [[year] for year in sorted({year for years in catalog.values() for year in years})]
     }
     return ORJSONResponse(content=data)
 
 
 @app.get("/aws/list/stations={stations}", response_class=ORJSONResponse)
-def list_station_years_endpoint(stations: str) -> ORJSONResponse:
-    station_list = tuple(station.replace('%20', ' ') for station in stations.split(','))
-    query = ("""SELECT DISTINCT(date_part('year', date)::int) as date
-             FROM aws_10min WHERE station_name IN %s ORDER BY date""", (station_list,))
-    data = query_database(query[0], query[1])["data"]
-    return ORJSONResponse(content=data)
+async def list_station_years_endpoint(stations: str) -> ORJSONResponse:
+    catalog = await load_aws_catalog()
+    station_list = [station.replace('%20', ' ') for station in stations.split(',')]
+    years = {year for station in station_list for year in catalog.get(station, ())}
+    return ORJSONResponse(content=[[year] for year in sorted(years)])
 
 
 @app.get("/aws/list/years={years}", response_class=ORJSONResponse)
-def list_yearly_stations_endpoint(years: str) -> ORJSONResponse:
-    years_list = tuple(year for year in years.split(','))
-    query = ("""SELECT DISTINCT(station_name)
-             FROM aws_10min WHERE date_part('year', date) IN %s ORDER BY station_name""", (years_list,))
-    data = query_database(query[0], query[1])["data"]
-    return ORJSONResponse(content=data)
+async def list_yearly_stations_endpoint(years: str) -> ORJSONResponse:
+    catalog = await load_aws_catalog()
+    years_list = [int(year) for year in years.split(',')]
+    stations = [station for station, station_years in sorted(catalog.items())
+                if any(year in station_years for year in years_list)]
+    return ORJSONResponse(content=[[station] for station in stations])
 
 
 @app.get("/aws/data", response_class=ORJSONResponse)
-def query_data_endpoint(query_type: str = "all",
-                        stations: str = None,
-                        interval: int = 2400,
-                        startdate: str = "19000101",
-                        enddate: str = "99991231",
-                        variable: str = None,
-                        grouping: str = None,
-                        download: bool = False) -> ORJSONResponse or StreamingResponse:
-    input_error = verify_input(query_type, stations, variable, grouping)
+async def query_data_endpoint(query_type: str = "all",
+                              stations: str = None,
+                              interval: int = 2400,
+                              startdate: str = "19000101",
+                              enddate: str = "99991231",
+                              variable: str = None,
+                              grouping: str = None,
+                              download: bool = False,
+                              format: str = "json",
+                              cursor: str = None) -> ORJSONResponse or StreamingResponse:
+    input_error = verify_input(query_type, stations, variable, grouping, format, cursor)
     if input_error:
         return ORJSONResponse({'error': input_error})
 
     stations = tuple(station.replace('%20', ' ') for station in stations.split(','))
+    metrics.label("branch", f"{query_type}:{grouping or '-'}:{'all' if 'all' in stations else 'list'}:"
+                            f"{'download' if download else format}")
     startdate = datetime.strptime(startdate, '%Y') if len(startdate) == 4 else datetime.strptime(startdate.replace('-',''), '%Y%m%d')
     enddate = datetime.strptime(enddate, '%Y') if len(enddate) == 4 else datetime.strptime(enddate.replace('-',''), '%Y%m%d')
-    query, params = generate_query(query_type, stations, interval, startdate, enddate,
-                                   variable, grouping, download)
-    data = query_database(query, params)
-    if download:
-        csv_stream = serve_csv(data, startdate, enddate)
-        return csv_stream
-    return ORJSONResponse(content=data)
+    after = decode_cursor(cursor) if cursor else None
+    ## Cost the request before running it. Later pages of an "all" query are costed from
+    ## their cursor's timestamp rather than startdate, as they read nothing before it
+    catalog = await load_aws_catalog()
+    read_rows, returned_rows = estimate_cost(catalog, query_type, stations, interval,
+                                             after[0] if after else startdate, enddate, grouping)
+    if query_type != "all" and not download and returned_rows > MAX_JSON_ROWS:
+        return ORJSONResponse({'error': f"Query would return about {returned_rows} rows, more than the "
+                                        f"{MAX_JSON_ROWS} allowed in a JSON response. Use a coarser grouping, "
+                                        "a shorter date range or download=True"})
+    heavy = read_rows > HEAVY_QUERY_ROWS
+    try:
+        if format in EXPORT_FORMATS:
+            query, params = generate_query(query_type, stations, interval, startdate, enddate,
+                                           variable, grouping, download=True, typed=True)
+            return await serve_export(query, params, list(dict.fromkeys(stations)),
+                                      startdate, enddate, format, heavy)
+        query, params = generate_query(query_type, stations, interval, startdate, enddate,
+                                       variable, grouping, download, typed=typed_query(format, download),
+                                       after=after)
+        if download:
+            csv_stream = await serve_csv(query, params, startdate, enddate, heavy)
+            return csv_stream
+    except QueryCanceled:
+        return ORJSONResponse({'error': QUERY_CANCELED_ERROR})
+    ## Results only depend on the set of stations, not the order they were given in
+    key = make_key(await data_version("aws"), "aws/data", query_type, sorted(set(stations)),
+                   interval, startdate, enddate, variable, grouping, format, after)
+    if (cached := get_response(key)) is not None:
+        metrics.label("cache", "hit")
+        return cached
+    metrics.label("cache", "miss")
+    try:
+        data = await query_database(query, params, heavy)
+    except QueryCanceled:
+        return ORJSONResponse({'error': QUERY_CANCELED_ERROR})
+    ## query_type=all is paged: the extra row fetched past PAGE_SIZE means more follow
+    if query_type == "all":
+        more = len(data["data"]) > PAGE_SIZE
+        data["data"] = data["data"][:PAGE_SIZE]
+        data["next"] = encode_cursor(data["header"], data["data"][-1]) if more else None
+        data["estimated_rows"] = estimate_rows(catalog, stations, interval, startdate, enddate)
+    if format == "columnar":
+        with metrics.timed("serialize"):
+            data = to_columns(data)
+    response = ORJSONResponse(content=data)
+    return put_response(key, response)
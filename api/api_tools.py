@@ -1,8 +1,28 @@
 from os import environ
-from typing import Tuple
-from datetime import datetime
-from psycopg2 import sql, pool
+from typing import AsyncIterator, Tuple
+from datetime import datetime, timedelta, timezone
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from time import monotonic, perf_counter
+from calendar import monthrange
+from contextlib import aclosing, asynccontextmanager
+import asyncio
+import psycopg
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 from fastapi.responses import StreamingResponse
+from io import BytesIO
+import numpy as np
+import orjson
+from metrics import timed, add
+import slow_log
+
+## pyarrow is optional: it has no PyPI wheels for Alpine (musl), so the Docker image
+## installs Alpine's py3-pyarrow; Arrow/Parquet exports are only offered where it is installed
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 ## Set DB credentials
 DB_NAME = environ.get("POSTGRES_DB")
@@ -11,329 +31,751 @@ DB_PASSWORD = environ.get("POSTGRES_PASSWORD")
 DB_HOST = environ.get("POSTGRES_HOST")
 DB_PORT = environ.get("POSTGRES_PORT")
 
-## Define Postgres connection pool for concurrent connections
+## Define async Postgres connection pool for concurrent connections.
+## Requests wait on the pool instead of occupying a worker thread. Each gunicorn
+## worker has its own pool, so workers * POOL_MAX_SIZE (4 * 20) stays below Postgres'
+## default max_connections of 100, leaving room for the loaders. Under bursts requests
+## queue for up to POOL_TIMEOUT seconds (at most POOL_MAX_WAITING of them, 0 for no
+## limit) before failing with 503. Connections are checked before being handed out
+## and replaced after POOL_MAX_LIFETIME seconds, so none outlive a database restart.
 CONNECTION_POOL = None
+POOL_MIN_SIZE = int(environ.get("POOL_MIN_SIZE", 2))
+POOL_MAX_SIZE = int(environ.get("POOL_MAX_SIZE", 20))
+POOL_TIMEOUT = float(environ.get("POOL_TIMEOUT", 30))
+POOL_MAX_WAITING = int(environ.get("POOL_MAX_WAITING", 200))
+POOL_MAX_LIFETIME = float(environ.get("POOL_MAX_LIFETIME", 1800))
+POOL_MAX_IDLE = float(environ.get("POOL_MAX_IDLE", 300))
+
+## Query intervals (in HHMM steps) precomputed in aws_10min.interval_bucket
+INTERVALS = (2400, 300, 100, 10)
+
+## Rows per JSON page of query_type=all; further pages are requested with the
+## returned cursor token (keyset pagination on ts, station_id)
+PAGE_SIZE = 10**4
+
+## Rows fetched per round trip when streaming results from a server-side cursor
+STREAM_BATCH_SIZE = 5000
+
+## Query cost guard. Requests are costed before they run from the station/year catalog
+## (see estimate_cost): aggregate JSON responses over MAX_JSON_ROWS are refused (they can
+## be downloaded instead), and queries reading more than HEAVY_QUERY_ROWS rows are heavy.
+## At most HEAVY_QUERY_SLOTS heavy queries run at once per worker, so they cannot take
+## every pooled connection from cheap requests. Every statement runs under a
+## statement_timeout (seconds), longer for heavy queries.
+MAX_JSON_ROWS = 10**5
+HEAVY_QUERY_ROWS = int(environ.get("HEAVY_QUERY_ROWS", 10**6))
+HEAVY_QUERY_SLOTS = int(environ.get("HEAVY_QUERY_SLOTS", 2))
+HEAVY_QUERIES = asyncio.Semaphore(HEAVY_QUERY_SLOTS)
+QUERY_TIMEOUT = int(environ.get("QUERY_TIMEOUT", 30))
+HEAVY_QUERY_TIMEOUT = int(environ.get("HEAVY_QUERY_TIMEOUT", 300))
+
+## Background EXPLAINs of slow queries (see slow_log.py), referenced until they finish
+EXPLAIN_TASKS = set()
+
+## Variables of aws_10min, in column order
+AWS_VARIABLES = ("temperature", "pressure", "wind_speed", "wind_direction", "humidity", "delta_t")
+
+## JSON formats of /aws/data: "json" (text values, Date/Time columns), "compact" (typed
+## rows with an epoch "ts" column) and "columnar" (typed, one array per column)
+JSON_FORMATS = ("json", "compact", "columnar")
+
+## Binary export formats of /aws/data: media type and file extension
+EXPORT_FORMATS = {"arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+                  "parquet": ("application/vnd.apache.parquet", "parquet")}
+PARQUET_ROW_GROUP_SIZE = 100000
+
+## Last line of a CSV download whose query failed after the response had started
+CSV_INCOMPLETE_LINE = "ERROR: the download was interrupted and this file is incomplete, please retry\n"
 
-def create_connection_pool():
+## Tables holding the last rebuild time of each dataset. Cached responses are keyed
+## on these, so a rebuild invalidates them. Lookups are reused for DATA_VERSION_TTL seconds.
+DATA_VERSION_TABLES = {"aws": "aws_10min_last_update", "realtime": "aws_realtime_last_update"}
+DATA_VERSION_TTL = 30
+DATA_VERSIONS = {}
+
+## In-memory copy of aws_10min_catalog, {station_name: {year: (rows, first_ts, last_ts)}},
+## reloaded whenever the AWS data version changes
+AWS_CATALOG = {}
+AWS_CATALOG_VERSION = None
+## {station_name: station_id} of the catalogued stations, for "all" query cursors
+AWS_STATION_IDS = {}
+
+## In-memory columnar copy of aws_realtime with the latest row per station, per-variable
+## max/min row indexes and stations by region; reloaded when the realtime version changes
+REALTIME_VARIABLES = ("temperature", "pressure", "wind_speed", "wind_direction", "humidity")
+REALTIME_COLUMNS = ("station_name", "region", "date", "time") + REALTIME_VARIABLES
+REALTIME_WINDOWS = ("current", "day", "week", "month")
+REALTIME_SNAPSHOT = None
+REALTIME_SNAPSHOT_VERSION = None
+
+async def open_connection_pool():
     global CONNECTION_POOL
-    CONNECTION_POOL = pool.SimpleConnectionPool(
-        minconn=1,
-        maxconn=100,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT,
-        database=DB_NAME
+    CONNECTION_POOL = AsyncConnectionPool(
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        timeout=POOL_TIMEOUT,
+        max_waiting=POOL_MAX_WAITING,
+        max_lifetime=POOL_MAX_LIFETIME,
+        max_idle=POOL_MAX_IDLE,
+        check=AsyncConnectionPool.check_connection,
+        kwargs={
+            "user": DB_USER,
+            "password": DB_PASSWORD,
+            "host": DB_HOST,
+            "port": DB_PORT,
+            "dbname": DB_NAME
+        },
+        open=False
     )
+    await CONNECTION_POOL.open()
 
-def get_connection():
+async def close_connection_pool():
     global CONNECTION_POOL
-    if CONNECTION_POOL is None:
-        create_connection_pool()
-    return CONNECTION_POOL.getconn()
+    if CONNECTION_POOL is not None:
+        await CONNECTION_POOL.close()
+        CONNECTION_POOL = None
 
-def return_connection(conn):
-    global CONNECTION_POOL
-    CONNECTION_POOL.putconn(conn)
-
-def query_database(query_string: str, args: Tuple = ()) -> dict:
-    postgres = get_connection()
-    with postgres:
-        database = postgres.cursor()
-        database.execute(query_string, args)
-        header = tuple(col[0] for col in database.description)
-        data = database.fetchall()
-        database.close()  # Close the cursor
-    return_connection(postgres)
+def pool_stats() -> dict:
+    ## Gauges and counters of this worker's pool (see psycopg_pool's get_stats),
+    ## plus the connections currently checked out
+    stats = CONNECTION_POOL.get_stats() if CONNECTION_POOL is not None else {}
+    stats["pool_in_use"] = stats.get("pool_size", 0) - stats.get("pool_available", 0)
+    return stats
+
+async def query_database(query_string: str, args: Tuple = (), heavy: bool = False) -> dict:
+    waiting = perf_counter()
+    async with query_slot(heavy), CONNECTION_POOL.connection() as postgres:
+        add("db_wait", perf_counter() - waiting)
+        async with postgres.cursor() as database:
+            started = perf_counter()
+            with timed("db_execute"):
+                await set_statement_timeout(database, heavy)
+                await database.execute(query_string, args)
+            header = tuple(col[0] for col in database.description)
+            with timed("fetch"):
+                data = await database.fetchall()
+            if slow_log.is_slow(elapsed := perf_counter() - started):
+                log_slow_query(render_query(query_string, postgres), args, elapsed, len(data), heavy)
+    add("rows", len(data))
     return {"header": header, "data": data}
 
+async def stream_query(query_string: str, args: Tuple = (), heavy: bool = False) -> AsyncIterator[Tuple]:
+    ## Execute a query on a named (server-side) cursor so results stay in Postgres
+    ## until requested. Yields the header first, then batches of rows. A heavy query
+    ## gives its slot back once the first batch is fetched, so slow clients downloading
+    ## the rest do not hold off other heavy queries.
+    waiting = perf_counter()
+    async with query_slot(heavy) as release_slot, CONNECTION_POOL.connection() as postgres:
+        add("db_wait", perf_counter() - waiting)
+        async with postgres.cursor(name="stream_query") as database:
+            ## The query itself mostly runs in the first fetch from a server-side cursor
+            started = perf_counter()
+            with timed("db_execute"):
+                await set_statement_timeout(postgres, heavy)
+                await database.execute(query_string, args)
+            with timed("fetch"):
+                rows = await database.fetchmany(STREAM_BATCH_SIZE)
+            release_slot()
+            if slow_log.is_slow(elapsed := perf_counter() - started):
+                log_slow_query(render_query(query_string, postgres), args, elapsed, None, heavy, streamed=True)
+            yield tuple(col[0] for col in database.description)
+            while rows:
+                add("rows", len(rows))
+                yield rows
+                with timed("fetch"):
+                    rows = await database.fetchmany(STREAM_BATCH_SIZE)
+
+def render_query(query_string: sql.Composable | str, postgres: psycopg.AsyncConnection) -> str:
+    return query_string.as_string(postgres) if isinstance(query_string, sql.Composable) else query_string
+
+def log_slow_query(sql_text: str, args: Tuple, seconds: float, rows: int | None,
+                   heavy: bool, streamed: bool = False) -> None:
+    ## Log a query slower than SLOW_QUERY_SECONDS (see slow_log.py). Its plan is
+    ## captured in the background so the response is not held up.
+    entry = slow_log.slow_query_entry(sql_text, args, seconds, rows, heavy)
+    options = slow_log.explain_options(entry, streamed)
+    if options is None:
+        slow_log.write(entry)
+        return
+    task = asyncio.create_task(explain_slow_query(entry, options))
+    EXPLAIN_TASKS.add(task)
+    task.add_done_callback(EXPLAIN_TASKS.discard)
+
+async def explain_slow_query(entry: dict, options: str) -> None:
+    ## Runs under the same heavy-query slot and statement_timeout as the query itself
+    try:
+        async with query_slot(entry["heavy"]), CONNECTION_POOL.connection() as postgres:
+            async with postgres.cursor() as database:
+                await set_statement_timeout(database, entry["heavy"])
+                await database.execute(f"EXPLAIN ({options}) {entry['sql']}", entry["params"])
+                explained = (await database.fetchone())[0]
+        entry["analyzed"] = "ANALYZE" in options
+        entry["plan_summary"] = slow_log.summarize_plan(explained)
+        entry["plan"] = explained
+    except Exception as error:
+        print("Error explaining slow query")
+        print(error)
+        entry["explain_error"] = str(error)
+    slow_log.write(entry)
+
+@asynccontextmanager
+async def query_slot(heavy: bool):
+    ## Heavy queries wait for one of the worker's HEAVY_QUERY_SLOTS before taking a
+    ## connection, for at most POOL_TIMEOUT seconds like the pool itself (PoolTimeout
+    ## is answered 503). Yields a function giving the slot back early.
+    released = not heavy
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            HEAVY_QUERIES.release()
+    if heavy:
+        try:
+            await asyncio.wait_for(HEAVY_QUERIES.acquire(), POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"no heavy query slot available after {POOL_TIMEOUT} sec")
+    try:
+        yield release
+    finally:
+        release()
+
+async def set_statement_timeout(database: psycopg.AsyncConnection | psycopg.AsyncCursor, heavy: bool) -> None:
+    ## Local to the transaction the query runs in, so it is reset when the
+    ## connection goes back to the pool
+    timeout = HEAVY_QUERY_TIMEOUT if heavy else QUERY_TIMEOUT
+    await database.execute("SELECT set_config('statement_timeout', %s, true)", (f"{timeout}s",))
+
+async def data_version(dataset: str) -> str | None:
+    version, checked = DATA_VERSIONS.get(dataset, (None, None))
+    if checked is not None and monotonic() - checked < DATA_VERSION_TTL:
+        return version
+    query = sql.SQL("SELECT MAX(last_update) FROM {}").format(
+        sql.Identifier(DATA_VERSION_TABLES[dataset]))
+    try:
+        last_update = (await query_database(query))["data"][0][0]
+        version = last_update.isoformat() if last_update else None
+    except psycopg.Error as error:
+        ## No version table yet: serve uncached rather than risk stale responses
+        print(f"Could not read {dataset} data version")
+        print(error)
+        version = None
+    DATA_VERSIONS[dataset] = (version, monotonic())
+    return version
+
+async def load_aws_catalog() -> dict:
+    global AWS_CATALOG, AWS_CATALOG_VERSION, AWS_STATION_IDS
+    version = await data_version("aws")
+    if AWS_CATALOG and version == AWS_CATALOG_VERSION:
+        return AWS_CATALOG
+    query = """SELECT station_name, station_id, year, rows, first_ts, last_ts
+               FROM aws_10min_catalog JOIN aws_station USING (station_id)
+               WHERE rows > 0 ORDER BY station_name, year"""
+    try:
+        catalog, station_ids = {}, {}
+        for station, station_id, year, rows, first_ts, last_ts in (await query_database(query))["data"]:
+            catalog.setdefault(station, {})[year] = (rows, first_ts, last_ts)
+            station_ids[station] = station_id
+        AWS_CATALOG, AWS_CATALOG_VERSION, AWS_STATION_IDS = catalog, version, station_ids
+    except psycopg.Error as error:
+        print("Could not load AWS catalog")
+        print(error)
+    return AWS_CATALOG
+
+async def load_realtime_snapshot() -> dict:
+    global REALTIME_SNAPSHOT, REALTIME_SNAPSHOT_VERSION
+    version = await data_version("realtime")
+    if REALTIME_SNAPSHOT is not None and version == REALTIME_SNAPSHOT_VERSION:
+        return REALTIME_SNAPSHOT
+    query = sql.SQL("""SELECT station_name, region, TO_CHAR(date, 'YYYY-MM-DD'),
+                       TO_CHAR(time, 'HH24:MI:SS'), {}
+                       FROM aws_realtime ORDER BY station_name, date, time""").format(
+        sql.SQL(", ").join(sql.Identifier(variable) for variable in REALTIME_VARIABLES))
+    ## Per-station extremes of the latest calendar day, week and month
+    aggregate_query = """SELECT window_type, variable, station_name,
+                         max_value, TO_CHAR(max_date, 'YYYY-MM-DD'), TO_CHAR(max_time, 'HH24:MI:SS'),
+                         min_value, TO_CHAR(min_date, 'YYYY-MM-DD'), TO_CHAR(min_time, 'HH24:MI:SS')
+                         FROM aws_realtime_aggregate agg
+                         WHERE period = (SELECT MAX(period) FROM aws_realtime_aggregate latest
+                                         WHERE latest.window_type = agg.window_type)"""
+    try:
+        rows = (await query_database(query))["data"]
+        aggregates = (await query_database(aggregate_query))["data"]
+    except psycopg.Error as error:
+        print("Could not load realtime snapshot")
+        print(error)
+        return REALTIME_SNAPSHOT or build_realtime_snapshot((), ())
+    REALTIME_SNAPSHOT, REALTIME_SNAPSHOT_VERSION = build_realtime_snapshot(rows, aggregates), version
+    return REALTIME_SNAPSHOT
+
+def build_realtime_snapshot(rows: list, aggregates: list) -> dict:
+    columns = dict(zip(REALTIME_COLUMNS, zip(*rows))) if rows else {column: () for column in REALTIME_COLUMNS}
+    ## Rows are ordered by date and time within each station, so the last index wins
+    latest = {station: index for index, station in enumerate(columns["station_name"])}
+    regions = {}
+    for station, index in sorted(latest.items(), key=lambda item: (columns["region"][item[1]], item[0])):
+        regions.setdefault(columns["region"][index], []).append(station)
+    ## Extremes as [station_name, date, time, value] per window and variable. "current"
+    ## covers all of aws_realtime; missing (NULL) and 444 sentinel readings never count.
+    extremes = {window: {variable: {"max": None, "min": None} for variable in REALTIME_VARIABLES}
+                for window in REALTIME_WINDOWS}
+    for variable in REALTIME_VARIABLES:
+        values = columns[variable]
+        valid = [index for index, value in enumerate(values) if value is not None and value != 444]
+        if valid:
+            fields = ("station_name", "date", "time", variable)
+            extremes["current"][variable] = {
+                "max": [columns[field][max(valid, key=values.__getitem__)] for field in fields],
+                "min": [columns[field][min(valid, key=values.__getitem__)] for field in fields],
+            }
+    for window, variable, station, *extreme in aggregates:
+        current = extremes[window][variable]
+        max_value, max_date, max_time, min_value, min_date, min_time = extreme
+        if current["max"] is None or max_value > current["max"][3]:
+            current["max"] = [station, max_date, max_time, max_value]
+        if current["min"] is None or min_value < current["min"][3]:
+            current["min"] = [station, min_date, min_time, min_value]
+    return {"columns": columns, "latest": latest, "regions": regions, "extremes": extremes}
+
+def snapshot_row(snapshot: dict, index: int, fields: Tuple) -> list:
+    return [snapshot["columns"][field][index] for field in fields]
+
 def generate_query(query_type: str, stations: list, interval: int, startdate: datetime, enddate: datetime,
-                   variable: int, grouping: str, download: bool) -> Tuple[sql.SQL, Tuple] | Tuple[None, None]:
+                   variable: int, grouping: str, download: bool,
+                   typed: bool = False, after: Tuple = None) -> Tuple[sql.SQL, Tuple] | Tuple[None, None]:
+    ## typed queries return measurements as numbers and each timestamp as one
+    ## epoch-seconds "ts" column, instead of text values and Date/Time columns.
+    ## after = (ts, station_id) continues an "all" query past that row.
 
     match query_type:
         ## Returns all datapoints (no aggregating) for time period by interval
         case "all":
-            limit_stmt = sql.SQL(f"LIMIT {10**5}") if download else sql.SQL(f"LIMIT {10**4}")
-            ## If variable is supplied, only return that column's values
-            if variable:
-                variable = sql.Identifier(variable)
-                return sql.SQL("""SELECT
-                                    station_name as Name,
-                                    TO_CHAR(date, 'YYYY-MM-DD') as Date,
-                                    TO_CHAR(time, 'HH24:MI') as Time,
-                                    CAST({} as TEXT)
-                                  FROM aws_10min
+            ## Downloads are streamed from a server-side cursor, so they are not capped
+            ## JSON pages fetch one extra row to tell whether another page follows.
+            limit_stmt = sql.SQL("") if download else sql.SQL(f"LIMIT {PAGE_SIZE + 1}")
+            interval_filter, interval_param = interval_condition(interval)
+            ## Seek past the last row of the previous page; the plain ts bound lets
+            ## each station's index range start at the cursor
+            seek_filter, seek_params = (sql.SQL("AND aws.ts >= %s AND (aws.ts, aws.station_id) > (%s, %s)"),
+                                        (after[0],) + tuple(after)) if after else (sql.SQL(""), ())
+            readings = sql.SQL("""aws.ts >= %s
+                                AND aws.ts < %s::date + 1
+                                {}""").format(seek_filter)
+            reading_params = (startdate, enddate) + seek_params
+            if download:
+                source = sql.SQL("""aws_10min aws
+                                  JOIN aws_station station USING (station_id)
                                   WHERE
-                                    station_name IN %s 
-                                    AND date >= %s 
-                                    AND date <= %s 
-                                    AND MOD((date_part('hour', time) * 100 + date_part('minute', time))::int, %s) = 0
-                                  ORDER BY date, time
-                                  {}""").format(variable,
-                                                limit_stmt),(stations, startdate, enddate, interval)
-            ## Else, return all columns
+                                    station.station_name = ANY(%s)
+                                    AND {}
+                                    AND {}""").format(interval_filter, readings)
+                params = (list(stations), interval_param) + reading_params
+            elif interval in INTERVALS:
+                ## A page takes at most a page of rows from each station and interval
+                ## bucket, read in ts order from the (station_id, interval_bucket, ts)
+                ## index, so its cost does not depend on how much of the date range
+                ## follows the cursor
+                source = sql.SQL("""aws_station station
+                                  CROSS JOIN unnest(%s::int[]) bucket(interval_bucket)
+                                  CROSS JOIN LATERAL (
+                                    SELECT * FROM aws_10min aws
+                                    WHERE
+                                      aws.station_id = station.station_id
+                                      AND aws.interval_bucket = bucket.interval_bucket
+                                      AND {}
+                                    ORDER BY aws.ts
+                                    {}) aws
+                                  WHERE station.station_name = ANY(%s)""").format(readings, limit_stmt)
+                params = (interval_param,) + reading_params + (list(stations),)
+            else:
+                ## Other intervals read each station in ts order from (station_id, ts)
+                source = sql.SQL("""aws_station station
+                                  CROSS JOIN LATERAL (
+                                    SELECT * FROM aws_10min aws
+                                    WHERE
+                                      aws.station_id = station.station_id
+                                      AND {}
+                                      AND {}
+                                    ORDER BY aws.ts
+                                    {}) aws
+                                  WHERE station.station_name = ANY(%s)""").format(interval_filter, readings,
+                                                                                  limit_stmt)
+                params = (interval_param,) + reading_params + (list(stations),)
+            ## If variable is supplied, only return that column's values
+            columns = sql.SQL(", ").join(value_column(sql.SQL("aws.{}").format(sql.Identifier(name)), typed)
+                                         for name in ((variable,) if variable else AWS_VARIABLES))
             return sql.SQL("""SELECT
-                                station_name as Name,
-                                TO_CHAR(date, 'YYYY-MM-DD') as Date,
-                                TO_CHAR(time, 'HH24:MI') as Time,
-                                CAST(temperature as TEXT),
-                                CAST(pressure as TEXT),
-                                CAST(wind_speed as TEXT),
-                                CAST(wind_direction as TEXT),
-                                CAST(humidity as TEXT),
-                                CAST(delta_t as TEXT)
-                            FROM aws_10min
-                            WHERE
-                                station_name IN %s 
-                                AND date >= %s 
-                                AND date <= %s 
-                                AND MOD((date_part('hour', time) * 100 + date_part('minute', time))::int, %s) = 0
-                            ORDER BY date, time
-                            {}""").format(limit_stmt), (stations, startdate, enddate, interval)
+                                station.station_name as Name,
+                                {},
+                                {}
+                              FROM {}
+                              ORDER BY aws.ts, aws.station_id
+                              {}""").format(ts_columns(sql.SQL("aws.ts"), typed),
+                                            columns,
+                                            source,
+                                            limit_stmt), params
 
         ## Max/min reading for a given variable from selected stations between two dates,
-        ## grouped by station and a given time period
+        ## grouped by station and a given time period. Served from the coarsest
+        ## precomputed rollup that covers the requested dates (see rollup_level).
         case "max" | "min":
-            variable = sql.Identifier(variable)
+            column = sql.Identifier(variable)
+            value, value_ts = (sql.Identifier(f"{query_type}_{field}") for field in ("value", "ts"))
             aggregator = sql.SQL('ASC') if query_type == "min" else sql.SQL('DESC')
-            query_type = sql.SQL(query_type)
+            params = (rollup_level(grouping, startdate, enddate), variable, startdate, enddate)
 
             ## Select overall max/min from entire database.
             if "all" in stations and grouping == "station":
-                return sql.SQL("""SELECT station_name, TO_CHAR(date, 'YYYY-MM-DD') as date, TO_CHAR(time, 'HH24:MI') as time, {}
-                                  FROM aws_10min WHERE {} != 444 AND date >= %s AND date <= %s
-                                  ORDER BY {} {} LIMIT 1""").format(variable, variable, variable, aggregator), (startdate, enddate)
+                return sql.SQL("""SELECT station_name, {}, {}
+                                  FROM aws_10min_rollup JOIN aws_station USING (station_id)
+                                  WHERE period_type = %s AND variable = %s AND period >= %s AND period <= %s
+                                  ORDER BY {} {}, {} LIMIT 1""").format(ts_columns(value_ts, typed),
+                                                                         value_column(value, typed, column),
+                                                                         value,
+                                                                         aggregator,
+                                                                         value_ts), params
 
+            if grouping not in ("station", "year", "month", "day"):
+                return None, None
             ## Select overall max/min from entire database, grouped by interval
-            if "all" in stations and grouping in ("year", "month", "day"):
-                grouping = sql.SQL(grouping)
-                return sql.SQL("""SELECT
-                                    aws.station_name as Name,
-                                    TO_CHAR(aws.date, 'YYYY-MM-DD') as Date,
-                                    TO_CHAR(aws.time, 'HH24:MI') as Time,
-                                    CAST(aws.{} as TEXT) as {}
-                                FROM (
-                                    SELECT
-                                        station_name,
-                                        date,
-                                        time,
-                                        {},
-                                        ROW_NUMBER() OVER (
-                                        PARTITION BY
-                                            date_trunc('{}', date)
-                                        ORDER BY
-                                            {} {}
-                                        ) as row_num
-                                    FROM
-                                        aws_10min
-                                    WHERE
-                                        date >= %s AND 
-                                        date <= %s AND 
-                                        {} != 444
-                                ) aws
-                                WHERE
-                                    row_num = 1
-                                ORDER BY
-                                    date""").format(variable,
-                                                    variable,
-                                                    variable,
-                                                    grouping,
-                                                    variable,
-                                                    aggregator,
-                                                    variable), (startdate, enddate)
-
+            if "all" in stations:
+                partition = sql.SQL("date_trunc({}, period)").format(sql.Literal(grouping))
+                station_filter = sql.SQL("")
             ## Select individual station max/min for all time
-            if grouping == "station":
-                return sql.SQL("""SELECT
-                                    aws.station_name as Name,
-                                    TO_CHAR(aws.date, 'YYYY-MM-DD') as Date,
-                                    TO_CHAR(aws.time, 'HH24:MI') as Time,
-                                    CAST(aws.{} as TEXT) as {}
-                                FROM (
-                                    SELECT
-                                        station_name,
-                                        date,
-                                        time,
-                                        {},
-                                        ROW_NUMBER() OVER (
-                                        PARTITION BY
-                                            station_name
-                                        ORDER BY
-                                            {} {}
-                                        ) as row_num
-                                    FROM
-                                        aws_10min
-                                    WHERE
-                                        station_name IN %s AND 
-                                        date >= %s AND 
-                                        date <= %s AND 
-                                        {} != 444
-                                ) aws
-                                WHERE
-                                    row_num = 1
-                                ORDER BY
-                                    aws.station_name, date""").format(variable,
-                                                                variable,
-                                                                variable,
-                                                                variable,
-                                                                aggregator,
-                                                                variable), (stations, startdate, enddate)
-
+            elif grouping == "station":
+                partition = sql.SQL("station_name")
+                station_filter = sql.SQL("AND station_name = ANY(%s)")
+                params += (list(stations),)
             ## Select individual station max/min, grouped by interval
-            if grouping in ("year", "month", "day"):
-                grouping = sql.SQL(grouping)
-                return sql.SQL("""SELECT
-                                    aws.station_name as Name,
-                                    TO_CHAR(aws.date, 'YYYY-MM-DD') as Date,
-                                    TO_CHAR(aws.time, 'HH24:MI') as Time,
-                                    CAST(aws.{} as TEXT) as {}
-                                FROM (
-                                    SELECT
-                                        station_name,
-                                        date,
-                                        time,
-                                        {},
-                                        ROW_NUMBER() OVER (
-                                        PARTITION BY
-                                            station_name,
-                                            date_trunc('{}', date)
-                                        ORDER BY
-                                            {} {}
-                                        ) as row_num
-                                    FROM
-                                        aws_10min
-                                    WHERE
-                                        station_name IN %s AND 
-                                        date >= %s AND 
-                                        date <= %s AND 
-                                        {} != 444
-                                ) aws
+            else:
+                partition = sql.SQL("station_name, date_trunc({}, period)").format(sql.Literal(grouping))
+                station_filter = sql.SQL("AND station_name = ANY(%s)")
+                params += (list(stations),)
+            ordering = sql.SQL("roll.period, roll.station_name") if "all" in stations\
+                       else sql.SQL("roll.station_name, roll.period")
+            return sql.SQL("""SELECT
+                                roll.station_name as Name,
+                                {},
+                                {}
+                            FROM (
+                                SELECT
+                                    station_name,
+                                    period,
+                                    {},
+                                    {},
+                                    ROW_NUMBER() OVER (
+                                    PARTITION BY
+                                        {}
+                                    ORDER BY
+                                        {} {}, {}
+                                    ) as row_num
+                                FROM
+                                    aws_10min_rollup JOIN aws_station USING (station_id)
                                 WHERE
-                                    row_num = 1
-                                ORDER BY
-                                    aws.station_name, date""").format(variable,
-                                                    variable,
-                                                    variable,
-                                                    grouping,
-                                                    variable,
-                                                    aggregator,
-                                                    variable), (stations, startdate, enddate)
+                                    period_type = %s AND
+                                    variable = %s AND
+                                    period >= %s AND
+                                    period <= %s
+                                    {}
+                            ) roll
+                            WHERE
+                                row_num = 1
+                            ORDER BY
+                                {}""").format(ts_columns(sql.SQL("roll.{}").format(value_ts), typed),
+                                              value_column(sql.SQL("roll.{}").format(value), typed, column),
+                                              value,
+                                              value_ts,
+                                              partition,
+                                              value,
+                                              aggregator,
+                                              value_ts,
+                                              station_filter,
+                                              ordering), params
 
 
         ## Calculate mean for a given variable for selected stations between two dates,
-        ## grouped by station and a given time period
+        ## grouped by station and a given time period. Means are recombined from the
+        ## rollup sums and counts, so they weight every reading equally.
         case "mean":
-            variable = sql.Identifier(variable)
+            params = (rollup_level(grouping, startdate, enddate), variable, startdate, enddate)
+            mean = value_column(sql.SQL("ROUND((SUM(total) / SUM(count))::numeric, 2)::float"), typed, sql.SQL("avg"))
             if "all" in stations and grouping == "station":
-                return sql.SQL("""SELECT AVG({}) FROM aws_10min
-                                  WHERE date >= %s AND date <= %s 
-                                  AND {} != 444""").format(variable, variable), (startdate, enddate)
+                return sql.SQL("""SELECT {} FROM aws_10min_rollup
+                                  WHERE period_type = %s AND variable = %s
+                                  AND period >= %s AND period <= %s""").format(mean), params
+
+            if grouping in ("year", "month", "day"):
+                date_format = sql.Literal("YYYY") if grouping == "year" else\
+                            sql.Literal("YYYY-MM") if grouping == "month" else\
+                            sql.Literal("YYYY-MM-DD")
+                timeperiod = sql.SQL("date_trunc({}, period)").format(sql.Literal(grouping))
 
             if "all" in stations and grouping in ("year", "month", "day"):
-                date_format = sql.SQL("YYYY") if grouping == "year" else\
-                            sql.SQL("YYYY-MM") if grouping == "month" else\
-                            sql.SQL("YYYY-MM-DD")
-                grouping = sql.SQL(grouping)
                 return sql.SQL("""SELECT
-                                    TO_CHAR(avg.timeperiod, '{}') as Duration,
-                                    CAST(avg.{} as TEXT) as avg {}
-                                FROM (
-                                    SELECT DISTINCT
-                                        date_trunc('{}', date) as timeperiod,
-                                        ROUND(AVG({})::numeric, 2)::float as {}
-                                    FROM
-                                        aws_10min 
-                                    WHERE
-                                        date >= %s AND 
-                                        date <= %s AND 
-                                        {} != 444 
-                                    GROUP BY
-                                        date_trunc('{}', date)
-                                ) avg
+                                    TO_CHAR({}, {}) as Duration,
+                                    {}
+                                FROM
+                                    aws_10min_rollup JOIN aws_station USING (station_id)
+                                WHERE
+                                    period_type = %s AND
+                                    variable = %s AND
+                                    period >= %s AND
+                                    period <= %s
+                                GROUP BY
+                                    {}
                                 ORDER BY
-                                    avg.timeperiod""").format(date_format,
-                                                            variable,
-                                                            variable,
-                                                            grouping,
-                                                            variable,
-                                                            variable,
-                                                            variable,
-                                                            grouping), (startdate, enddate)
-
+                                    {}""").format(timeperiod,
+                                                  date_format,
+                                                  mean,
+                                                  timeperiod,
+                                                  timeperiod), params
 
             if grouping == "station":
                 return sql.SQL("""SELECT
-                                    avg.station_name as Name, 
-                                    CAST(avg.{} as TEXT) as AVG
-                                FROM (
-                                    SELECT DISTINCT
-                                        station_name,
-                                        ROUND(AVG({})::numeric, 2)::float as {}
-                                    FROM
-                                        aws_10min 
-                                    WHERE
-                                        station_name IN %s AND 
-                                        date >= %s AND 
-                                        date <= %s AND 
-                                        {} != 444 
-                                    GROUP BY
-                                        station_name
-                                ) avg
+                                    station_name as Name,
+                                    {}
+                                FROM
+                                    aws_10min_rollup JOIN aws_station USING (station_id)
+                                WHERE
+                                    period_type = %s AND
+                                    variable = %s AND
+                                    period >= %s AND
+                                    period <= %s AND
+                                    station_name = ANY(%s)
+                                GROUP BY
+                                    station_name
                                 ORDER BY
-                                    avg.timeperiod""").format(variable,
-                                                              variable,
-                                                              variable,
-                                                              variable), (stations, startdate, enddate)
+                                    station_name""").format(mean), params + (list(stations),)
 
             if grouping in ("year", "month", "day"):
-                date_format = sql.SQL("YYYY") if grouping == "year" else\
-                            sql.SQL("YYYY-MM") if grouping == "month" else\
-                            sql.SQL("YYYY-MM-DD")
-                grouping = sql.SQL(grouping)
                 return sql.SQL("""SELECT
-                                    avg.station_name as Name, 
-                                    TO_CHAR(avg.timeperiod, '{}') as Duration,
-                                    CAST(avg.{} as TEXT) as AVG
-                                FROM (
-                                    SELECT DISTINCT
-                                        station_name,
-                                        date_trunc('{}', date) as timeperiod,
-                                        ROUND(AVG({})::numeric, 2)::float as {}
-                                    FROM
-                                        aws_10min 
-                                    WHERE
-                                        station_name IN %s AND 
-                                        date >= %s AND 
-                                        date <= %s AND 
-                                        {} != 444 
-                                    GROUP BY
-                                        station_name, 
-                                        date_trunc('{}', date)
-                                ) avg
+                                    station_name as Name,
+                                    TO_CHAR({}, {}) as Duration,
+                                    {}
+                                FROM
+                                    aws_10min_rollup JOIN aws_station USING (station_id)
+                                WHERE
+                                    period_type = %s AND
+                                    variable = %s AND
+                                    period >= %s AND
+                                    period <= %s AND
+                                    station_name = ANY(%s)
+                                GROUP BY
+                                    station_name,
+                                    {}
                                 ORDER BY
-                                    avg.timeperiod""").format(date_format,
-                                                            variable,
-                                                            grouping,
-                                                            variable,
-                                                            variable,
-                                                            variable,
-                                                            grouping), (stations, startdate, enddate)
+                                    {},
+                                    station_name""").format(timeperiod,
+                                                            date_format,
+                                                            mean,
+                                                            timeperiod,
+                                                            timeperiod), params + (list(stations),)
+            return None, None
 
         case other:
             return None, None
 
-def serve_csv(data: dict, startdate: str, enddate: str) -> StreamingResponse:
+def interval_condition(interval: int) -> Tuple[sql.SQL, int | list]:
+    ## Standard intervals match the indexed interval_bucket column (each reading's
+    ## coarsest interval); any other step is computed from the time of day
+    if interval in INTERVALS:
+        return sql.SQL("aws.interval_bucket = ANY(%s)"), [bucket for bucket in INTERVALS if bucket >= interval]
+    return sql.SQL("MOD((date_part('hour', aws.ts) * 100 + date_part('minute', aws.ts))::int, %s) = 0"), interval
+
+def typed_query(format: str, download: bool) -> bool:
+    ## Compact/columnar JSON responses read typed rows; "json" and CSV downloads
+    ## (whatever the format) need text values. Binary exports are always typed.
+    return format in EXPORT_FORMATS or (format != "json" and not download)
+
+def ts_columns(column: sql.Composable, typed: bool) -> sql.Composed:
+    ## A timestamp as Date and Time text columns, or (typed) one epoch-seconds column
+    if typed:
+        return sql.SQL("EXTRACT(EPOCH FROM {})::bigint as ts").format(column)
+    return sql.SQL("TO_CHAR({0}, 'YYYY-MM-DD') as Date, TO_CHAR({0}, 'HH24:MI') as Time").format(column)
+
+def value_column(value: sql.Composable, typed: bool, alias: sql.Composable = None) -> sql.Composed:
+    ## A measurement as text, or (typed) as its native number
+    column = value if typed else sql.SQL("CAST({} as TEXT)").format(value)
+    return sql.SQL("{} as {}").format(column, alias) if alias is not None else column
+
+def to_columns(result: dict) -> dict:
+    ## Transpose query rows into one array per column. Numeric columns become NumPy
+    ## arrays, which orjson serializes natively (NaN as null); text columns stay lists.
+    ## Other keys (paging) are kept.
+    columns = {}
+    for name, values in zip(result["header"], zip(*result["data"]) if result["data"] else [()] * len(result["header"])):
+        kind = next((type(value) for value in values if value is not None), None)
+        if kind is int and None not in values:
+            columns[name] = np.array(values, dtype=np.int64)
+        elif kind in (int, float):
+            columns[name] = np.array(values, dtype=np.float64)
+        else:
+            columns[name] = list(values)
+    columnar = {key: value for key, value in result.items() if key != "data"}
+    columnar["columns"] = columns
+    return columnar
+
+def encode_cursor(header: Tuple, row: Tuple) -> str:
+    ## Opaque continuation token for the (ts, station_id) of a query_type=all row, the
+    ## key "all" queries are ordered by (see generate_query)
+    if "ts" in header:
+        ts = datetime.fromtimestamp(row[1], timezone.utc).replace(tzinfo=None)
+    else:
+        ts = datetime.strptime(f"{row[1]} {row[2]}", "%Y-%m-%d %H:%M")
+    return urlsafe_b64encode(orjson.dumps([ts.isoformat(), AWS_STATION_IDS[row[0]]])).decode()
+
+def decode_cursor(token: str) -> Tuple | None:
+    try:
+        ts, station_id = orjson.loads(urlsafe_b64decode(token.encode()))
+        return datetime.fromisoformat(ts), int(station_id)
+    except (ValueError, TypeError):
+        return None
+
+def estimate_rows(catalog: dict, stations: list, interval: int, startdate: datetime, enddate: datetime) -> int:
+    ## Rows a query_type=all request would return, from the catalog's station/year row
+    ## counts: the share of each year's coverage inside the date range, times the
+    ## share of the day's 10-minute readings that fall on the interval
+    slots = [hour * 100 + minute for hour in range(24) for minute in range(0, 60, 10)]
+    selectivity = sum(1 for slot in slots if slot % interval == 0) / len(slots) if interval > 0 else 1
+    end = min(enddate, datetime(9999, 12, 30)) + timedelta(days=1)
+    total = 0
+    for station in set(stations):
+        for year, (rows, first_ts, last_ts) in catalog.get(station, {}).items():
+            if year < startdate.year or year > enddate.year:
+                continue
+            span = (last_ts - first_ts).total_seconds()
+            overlap = (min(end, last_ts + timedelta(minutes=10)) - max(startdate, first_ts)).total_seconds()
+            total += rows * max(0, min(1, overlap / span)) if span > 0 else rows
+    return round(total * selectivity)
+
+def estimate_cost(catalog: dict, query_type: str, stations: list, interval: int,
+                  startdate: datetime, enddate: datetime, grouping: str) -> Tuple[int, int]:
+    ## Rows a request reads and rows it returns, from the catalog alone. "all" reads
+    ## what it returns; max/min/mean read one rollup row per station and rollup period
+    ## and return one row per group (station and/or grouping period).
+    if query_type == "all":
+        rows = estimate_rows(catalog, stations, interval, startdate, enddate)
+        return rows, rows
+    level = rollup_level(grouping, startdate, enddate)
+    selected = catalog if "all" in stations else {station: catalog[station] for station in set(stations)
+                                                  if station in catalog}
+    read, returned, periods_by_year = 0, 0, {}
+    for station, years in selected.items():
+        for year, (_, first_ts, last_ts) in years.items():
+            start, end = max(startdate.date(), first_ts.date()), min(enddate.date(), last_ts.date())
+            if start > end:
+                continue
+            read += count_periods(level, start, end)
+            if grouping != "station":
+                periods = count_periods(grouping, start, end)
+                returned += periods
+                periods_by_year[year] = max(periods, periods_by_year.get(year, 0))
+    if grouping == "station":
+        returned = 1 if "all" in stations else len(selected)
+    elif "all" in stations:
+        ## Stations share grouping periods, so count each period once
+        returned = sum(periods_by_year.values())
+    return read, returned
+
+def count_periods(period: str, start: datetime, end: datetime) -> int:
+    ## Calendar days, months or years touched by [start, end]
+    if period == "year":
+        return end.year - start.year + 1
+    if period == "month":
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return (end - start).days + 1
+
+def rollup_level(grouping: str, startdate: datetime, enddate: datetime) -> str:
+    ## Pick the coarsest rollup whose periods exactly tile [startdate, enddate] and
+    ## are no coarser than the requested grouping. Daily rows always fit.
+    month_aligned = startdate.day == 1 and enddate.day == monthrange(enddate.year, enddate.month)[1]
+    if grouping in ("year", "station") and month_aligned and startdate.month == 1 and enddate.month == 12:
+        return "year"
+    if grouping in ("year", "month", "station") and month_aligned:
+        return "month"
+    return "day"
+
+async def serve_csv(query_string: str, args: Tuple, startdate: datetime, enddate: datetime,
+                    heavy: bool = False) -> StreamingResponse:
     citation = create_citation(startdate.strftime('%Y-%m'), enddate.strftime('%Y-%m'))
     filename = f"AMRDC Data Warehouse {datetime.now().date()}.csv"
-    async def csv_generator(data):
-        yield citation
-        yield ','.join(data["header"])
-        for row in data["data"]:
-            yield ','.join(row)
-    return StreamingResponse(csv_generator(data),
+    ## The query runs up to its first batch before the response starts, so a busy pool
+    ## or a cancelled query is still answered with an error instead of a 200
+    batches = stream_query(query_string, args, heavy)
+    header = await anext(batches)
+    async def csv_generator():
+        ## One chunk is sent per fetched batch; aclosing returns the connection
+        ## to the pool even if the client disconnects mid-download.
+        async with aclosing(batches):
+            yield citation + '\n'
+            yield ','.join(header) + '\n'
+            try:
+                async for rows in batches:
+                    yield ''.join(','.join('' if value is None else value for value in row) + '\n'
+                                  for row in rows)
+            except psycopg.Error as error:
+                ## Too late for an error response: end the file with an error line so
+                ## it cannot pass for a complete download
+                print("Error streaming CSV download")
+                print(error)
+                yield CSV_INCOMPLETE_LINE
+    return StreamingResponse(csv_generator(),
                              media_type="text/csv",
                              headers={"Content-Disposition": f"attachment; filename={filename}"})
 
+async def serve_export(query_string: str, args: Tuple, stations: list, startdate: datetime,
+                       enddate: datetime, file_format: str, heavy: bool = False) -> StreamingResponse:
+    ## Stream a typed "all" query (see generate_query) as an Arrow IPC stream or a Parquet
+    ## file. Each fetched batch becomes a record batch (Parquet: buffered into row groups)
+    ## with timestamp, float32 and dictionary-encoded station columns. As with CSV, the
+    ## query runs up to its first batch before the response starts; a failure after that
+    ## aborts the transfer, leaving a stream without its end marker (or a Parquet file
+    ## without its footer) that readers reject.
+    citation = create_citation(startdate.strftime('%Y-%m'), enddate.strftime('%Y-%m'))
+    media_type, extension = EXPORT_FORMATS[file_format]
+    filename = f"AMRDC Data Warehouse {datetime.now().date()}.{extension}"
+    ## One dictionary for the whole stream, so every batch shares it
+    station_names = pa.array(stations, pa.string())
+    station_index = {station: index for index, station in enumerate(stations)}
+    batches = stream_query(query_string, args, heavy)
+    header = await anext(batches)
+    async def export_generator():
+        async with aclosing(batches):
+            schema = pa.schema([("name", pa.dictionary(pa.int16(), pa.string())),
+                                ("ts", pa.timestamp("s"))]
+                               + [(column, pa.float32()) for column in header[2:]],
+                               metadata={"citation": citation})
+            sink = BytesIO()
+            writer = pa.ipc.new_stream(sink, schema) if file_format == "arrow"\
+                     else pq.ParquetWriter(sink, schema)
+            pending = []
+            async for rows in batches:
+                names, timestamps, *readings = zip(*rows)
+                batch = pa.record_batch(
+                    [pa.DictionaryArray.from_arrays(pa.array([station_index[name] for name in names], pa.int16()),
+                                                    station_names),
+                     pa.array(timestamps, pa.int64()).cast(pa.timestamp("s"))]
+                    + [pa.array(values, pa.float32()) for values in readings], schema=schema)
+                if file_format == "arrow":
+                    writer.write_batch(batch)
+                else:
+                    pending.append(batch)
+                    if sum(len(batch) for batch in pending) < PARQUET_ROW_GROUP_SIZE:
+                        continue
+                    writer.write_table(pa.Table.from_batches(pending))
+                    pending = []
+                ## Nothing to send while the writer is still buffering
+                if sink.tell():
+                    yield sink.getvalue()
+                    sink.seek(0)
+                    sink.truncate()
+            if pending:
+                writer.write_table(pa.Table.from_batches(pending))
+            writer.close()
+            yield sink.getvalue()
+    return StreamingResponse(export_generator(),
+                             media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 def create_citation(startdate: str, enddate: str) -> str:
     date = f"{startdate} - {enddate}"
     citation = "Antarctic Meteorological Research and Data Center: Automatic Weather Station " +\
@@ -344,7 +786,9 @@ def create_citation(startdate: str, enddate: str) -> str:
 def verify_input(query_type: str,
                  stations: str,
                  variable: str,
-                 grouping: str) -> str | None:
+                 grouping: str,
+                 format: str = "json",
+                 cursor: str = None) -> str | None:
     if query_type == "all" and stations is None:
         return "Data query requires following variables: stations (comma-separated)"
     elif query_type in ("max", "min", "mean") and None in (stations, variable, grouping):
@@ -352,4 +796,12 @@ def verify_input(query_type: str,
                "measurement variable (i.e. 'temperature'), grouping (day, month, year, or station)"
     elif query_type not in ("all", "max", "min", "mean"):
         return "Unrecognized query type. Must be one of: 'all', 'max', 'min', 'mean'"
+    elif cursor is not None and (query_type != "all" or decode_cursor(cursor) is None):
+        return "Invalid cursor. Cursors are returned as 'next' by query type 'all'"
+    elif format not in JSON_FORMATS + tuple(EXPORT_FORMATS):
+        return "Unrecognized format. Must be one of: 'json', 'compact', 'columnar', 'arrow', 'parquet'"
+    elif format in EXPORT_FORMATS and pa is None:
+        return f"{format} export is not available on this server"
+    elif format in EXPORT_FORMATS and query_type != "all":
+        return f"{format} export is only available for query type 'all'"
     return None
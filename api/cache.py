@@ -0,0 +1,93 @@
+from os import environ, fstat, getpid, makedirs, replace, scandir, unlink, utime
+from os.path import join
+from time import time
+from hashlib import sha256
+import orjson
+from fastapi.responses import Response
+
+## Serialized JSON responses are cached as files so that every gunicorn worker
+## shares one cache: a response built by one worker is served by all of them.
+## Keys include the data version of the tables behind the endpoint, so entries
+## built before an AWS or realtime rebuild are never served afterwards; they
+## simply age out. Eviction is least-recently-used by file access time.
+## CACHE_MAX_BYTES=0 turns the cache off: nothing is read from or written to it.
+CACHE_DIR = environ.get("CACHE_DIR", "/tmp/amrdc_api_cache")
+CACHE_MAX_BYTES = int(environ.get("CACHE_MAX_BYTES", 128 * 2**20))
+CACHE_TTL = int(environ.get("CACHE_TTL", 24 * 3600))
+
+## Run an eviction pass after this many writes from a worker
+EVICT_EVERY = 50
+writes_since_eviction = 0
+
+makedirs(CACHE_DIR, exist_ok=True)
+
+def make_key(version: str | None, *parts) -> str | None:
+    ## Parts must already be normalized (sorted station tuples, parsed dates...).
+    ## Without a data version there is nothing to invalidate on, so don't cache.
+    if version is None:
+        return None
+    return sha256(orjson.dumps((version,) + parts, default=str)).hexdigest()
+
+def get_response(key: str | None) -> Response | None:
+    if key is None or not CACHE_MAX_BYTES:
+        return None
+    path = join(CACHE_DIR, key)
+    try:
+        with open(path, "rb") as cached:
+            created = fstat(cached.fileno()).st_mtime
+            body = cached.read()
+    except FileNotFoundError:
+        return None
+    now = time()
+    if now - created > CACHE_TTL:
+        return None
+    ## Record the hit in the access time only; mtime stays the creation time for the TTL
+    try:
+        utime(path, (now, created))
+    except FileNotFoundError:
+        pass
+    return Response(content=body, media_type="application/json")
+
+def put_response(key: str | None, response: Response) -> Response:
+    global writes_since_eviction
+    if key is None or not CACHE_MAX_BYTES or response.status_code != 200\
+            or len(response.body) > CACHE_MAX_BYTES // 10:
+        return response
+    ## Write then rename, so other workers never read a partial entry
+    partial = join(CACHE_DIR, f".{key}.{getpid()}")
+    with open(partial, "wb") as entry:
+        entry.write(response.body)
+    replace(partial, join(CACHE_DIR, key))
+    writes_since_eviction += 1
+    if writes_since_eviction >= EVICT_EVERY:
+        writes_since_eviction = 0
+        evict()
+    return response
+
+def evict() -> None:
+    ## Drop expired entries, then least recently used ones until the cache is back
+    ## under 90% of CACHE_MAX_BYTES
+    now = time()
+    entries, total = [], 0
+    for entry in scandir(CACHE_DIR):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.startswith(".") or now - stat.st_mtime > CACHE_TTL:
+            if now - stat.st_mtime > 60:
+                remove(entry.path)
+            continue
+        entries.append((stat.st_atime, stat.st_size, entry.path))
+        total += stat.st_size
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES * 0.9:
+            break
+        remove(path)
+        total -= size
+
+def remove(path: str) -> None:
+    try:
+        unlink(path)
+    except FileNotFoundError:
+        pass
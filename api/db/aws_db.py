@@ -1,18 +1,63 @@
 """Initialize/rebuild the historical AWS database tables for the AMRDC AWS API"""
 import urllib3
 import json
+import warnings
+from io import BytesIO
+from os import cpu_count
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
 from datetime import datetime
-from config import postgres
+from hashlib import md5
+import numpy as np
+from config import postgres, log_slow_ingest
 import test
 
-## Define HTTP connection pool manager
-http = urllib3.PoolManager()
+## Concurrent downloads, parser processes and datafiles held in memory at once
+DOWNLOAD_WORKERS = 8
+PARSE_WORKERS = min(4, cpu_count() or 1)
+MAX_IN_FLIGHT = 16
+
+## Define HTTP connection pool manager, sized for the concurrent downloads
+http = urllib3.PoolManager(maxsize=DOWNLOAD_WORKERS)
+
+## Rows sent to Postgres per COPY statement
+COPY_BATCH_SIZE = 50000
+
+## Datafile columns: year, day of year, month, day, HHMM, then the VARIABLES readings.
+## 444 is the missing-reading sentinel and is loaded as NULL.
+DATAFILE_COLUMNS = 11
+MISSING = 444
+
+## Binary COPY framing: file header (signature, flags, extension length) and trailer
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+COPY_TRAILER = b"\xff\xff"
+POSTGRES_EPOCH = np.datetime64("2000-01-01T00:00", "us")
+
+## Measurement columns summarized in the aws_10min_rollup table
+VARIABLES = ("temperature", "pressure", "wind_speed", "wind_direction", "humidity", "delta_t")
+
+## Columns of aws_10min in the order the loader writes them
+COLUMNS = ("station_id", "ts", "interval_bucket") + VARIABLES
+
+## Query intervals (in HHMM steps), coarsest first. Each reading's interval_bucket is
+## the coarsest interval its time of day falls on, so an interval query selects
+## interval_bucket >= interval. Readings off the 10-minute grid get bucket 0.
+INTERVALS = (2400, 300, 100, 10)
+
+## aws_station keys looked up during this run, by station name
+STATION_IDS = {}
 
 def extract_resource_list(dataset: dict) -> tuple:
-    """Receives a dict of an AMRDC AWS dataset and returns its resource urls."""
+    """Receives a dict of an AMRDC AWS dataset and returns its resources as
+    (station name, url, last modified, size) tuples."""
     try:
         name,_ = dataset["title"].split(" Automatic Weather Station,")
-        resource_list = tuple((name, resource["url"])
+        resource_list = tuple((name,
+                               resource["url"],
+                               datetime.fromisoformat(resource["last_modified"])
+                               if resource.get("last_modified") else None,
+                               resource.get("size"))
                           for resource in dataset["resources"]
                           if "10min" in resource["name"])
         return resource_list
@@ -39,30 +84,280 @@ def get_resource_urls() -> tuple:
         print(error)
 
 
-def process_datapoint(name: str, line: str) -> tuple:
-    """Accepts a row of data from a datafile and returns a formatted dict"""
+def read_table(name: str, data: bytes) -> np.ndarray:
+    """Reads a datafile's rows into a float64 array in one pass, skipping the two
+    header lines. Files with malformed lines are re-read keeping only complete,
+    numeric rows."""
     try:
-        row = line.split()
-        formatted_date = f"{row[0]}-{row[2]}-{row[3]}"
-        params = (name,formatted_date) + tuple(row[4:])
-        return params
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            table = np.loadtxt(BytesIO(data), skiprows=2, ndmin=2)
+        if table.shape[1] == DATAFILE_COLUMNS or not len(table):
+            return table.reshape(-1, DATAFILE_COLUMNS)
+    except ValueError:
+        pass
+    rows = []
+    for line in data.split(b"\n")[2:]:
+        try:
+            row = [float(token) for token in line.split()]
+        except ValueError:
+            continue
+        if len(row) == DATAFILE_COLUMNS:
+            rows.append(row)
+    print(f"Dropped malformed lines from resource: {name}")
+    return np.array(rows, dtype=np.float64).reshape(-1, DATAFILE_COLUMNS)
+
+
+def process_datafile(name: str, data: bytes) -> dict:
+    """Parses a datafile into columns: ts (datetime64), interval_bucket and the
+    VARIABLES readings (float32, NaN where missing)"""
+    try:
+        table = read_table(name, data)
+        year, month, day, hour_minute = (table[:, column].astype(np.int64) for column in (0, 2, 3, 4))
+        minutes = (day - 1) * 1440 + hour_minute // 100 * 60 + hour_minute % 100
+        ts = ((year - 1970).astype("M8[Y]").astype("M8[M]") + (month - 1).astype("m8[M]")).astype("M8[m]")\
+             + minutes.astype("m8[m]")
+        ## Finest interval first, so coarser intervals overwrite it
+        interval_bucket = np.zeros(len(table), dtype=np.int16)
+        for interval in reversed(INTERVALS):
+            interval_bucket[hour_minute % interval == 0] = interval
+        readings = table[:, 5:]
+        readings[readings == MISSING] = np.nan
+        columns = {"ts": ts, "interval_bucket": interval_bucket}
+        columns.update(zip(VARIABLES, readings.astype(np.float32).T))
+        return columns
     except Exception as error:
-        print(f"Error processing datapoint: {name}\n{line}")
+        print(f"Could not process resource: {name}")
         print(error)
+        return {"ts": np.array([], dtype="M8[m]")}
+
 
+def render_copy(station_id: int, columns: dict) -> bytes:
+    """Renders parsed columns as a binary COPY stream for COLUMNS. Every row is laid
+    out in a fixed-width record; the value bytes of NULL readings are then masked out,
+    which leaves the variable-length rows COPY expects."""
+    rows = len(columns["ts"])
+    record = np.dtype([("fields", ">i2"),
+                       ("station_id_len", ">i4"), ("station_id", ">i2"),
+                       ("ts_len", ">i4"), ("ts", ">i8"),
+                       ("interval_bucket_len", ">i4"), ("interval_bucket", ">i2")]
+                      + [field for variable in VARIABLES
+                         for field in ((f"{variable}_len", ">i4"), (variable, ">f4"))])
+    records = np.zeros(rows, dtype=record)
+    records["fields"] = len(COLUMNS)
+    records["station_id_len"], records["station_id"] = 2, station_id
+    records["ts_len"] = 8
+    records["ts"] = (columns["ts"] - POSTGRES_EPOCH).astype(np.int64)
+    records["interval_bucket_len"], records["interval_bucket"] = 2, columns["interval_bucket"]
+    keep = np.ones((rows, record.itemsize), dtype=bool)
+    for variable in VARIABLES:
+        missing = np.isnan(columns[variable])
+        records[f"{variable}_len"] = np.where(missing, -1, 4)
+        records[variable] = columns[variable]
+        offset = record.fields[variable][1]
+        keep[:, offset:offset + 4] = ~missing[:, None]
+    return COPY_HEADER + records.view(np.uint8).reshape(rows, record.itemsize)[keep].tobytes() + COPY_TRAILER
 
-def process_datafile(resource: tuple) -> tuple:
-    """Accesses a datafile via URL and returns a list containing each row"""
-    name, url = resource
+
+def download_datafile(resource: tuple) -> tuple:
+    """Download stage: fetches a datafile via URL and returns its contents,
+    MD5 digest and fetch time"""
+    name, url, *_ = resource
+    start = perf_counter()
     try:
         global http
         datafile = http.request("GET", url, retries=5)
-        data = datafile.data.decode('utf-8').strip().split('\n')[2:]
-        formatted_datafile = tuple(process_datapoint(name, line) for line in data)
-        return formatted_datafile
+        return datafile.data, md5(datafile.data).hexdigest(), perf_counter() - start
     except Exception as error:
-        print(f"Could not process resource: {name}\n{url}")
+        print(f"Could not download resource: {name}\n{url}")
         print(error)
+        return b"", None, perf_counter() - start
+
+
+def parse_datafile(station_id: int, name: str, data: bytes) -> tuple:
+    """Parser stage: renders a datafile as binary COPY batches of COPY_BATCH_SIZE rows,
+    along with the first and last dates it covers. Runs in a worker process, so it
+    returns bytes rather than arrays of Python objects."""
+    start = perf_counter()
+    columns = process_datafile(name, data)
+    rows = len(columns["ts"])
+    batches = [render_copy(station_id, {column: values[offset:offset + COPY_BATCH_SIZE]
+                                        for column, values in columns.items()})
+               for offset in range(0, rows, COPY_BATCH_SIZE)]
+    period = (columns["ts"].min().astype("M8[D]").item(),
+              columns["ts"].max().astype("M8[D]").item()) if rows else (None, None)
+    return rows, batches, period, perf_counter() - start
+
+
+def copy_batches(db, table: str, batches: list) -> None:
+    """Writer stage: streams binary COPY batches into a table with COPY FROM STDIN"""
+    for batch in batches:
+        db.copy_expert(f"COPY {table} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+                       BytesIO(batch))
+
+
+def create_aws_table(db, table: str) -> None:
+    """Creates an empty 10-minute table, range partitioned by year on ts"""
+    db.execute(f"""CREATE TABLE {table} (
+                station_id SMALLINT,
+                ts TIMESTAMP,
+                interval_bucket SMALLINT,
+                temperature REAL,
+                pressure REAL,
+                wind_speed REAL,
+                wind_direction REAL,
+                humidity REAL,
+                delta_t REAL) PARTITION BY RANGE (ts)""")
+
+
+def create_partitions(db, table: str, first_year: int, last_year: int) -> None:
+    """Creates any missing yearly partitions of `table` between two years"""
+    for year in range(first_year, last_year + 1):
+        db.execute(f"""CREATE TABLE IF NOT EXISTS {table}_y{year} PARTITION OF {table}
+                    FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')""")
+
+
+def create_aws_indexes(db, table: str = "aws_10min") -> None:
+    """Indexes a 10-minute table; built once after loading. Partitions inherit the indexes."""
+    prefix = table.removeprefix("aws")
+    db.execute(f"CREATE INDEX IF NOT EXISTS idx{prefix}_station_ts ON {table} (station_id, ts)")
+    db.execute(f"""CREATE INDEX IF NOT EXISTS idx{prefix}_station_interval_ts
+                ON {table} (station_id, interval_bucket, ts)""")
+
+
+def get_station_id(db, name: str) -> int:
+    """Returns the aws_station key for a station name, adding the station if new"""
+    if name not in STATION_IDS:
+        db.execute("""INSERT INTO aws_station (station_name) VALUES (%s)
+                    ON CONFLICT (station_name) DO NOTHING""", (name,))
+        db.execute("SELECT station_id FROM aws_station WHERE station_name = %s", (name,))
+        STATION_IDS[name] = db.fetchone()[0]
+    return STATION_IDS[name]
+
+
+def load_resources(db, table: str, resources: tuple, manifest: dict = None) -> set:
+    """Downloads AWS resources and bulk loads them into `table`, recording each in
+    aws_10min_manifest. Returns the names of stations whose rows changed.
+    Downloads run on a thread pool and parsing on a process pool, feeding this
+    thread's single COPY writer. At most MAX_IN_FLIGHT files are held in memory
+    at once; new downloads only start as earlier files are written.
+    When a manifest of previously loaded resources is given, each resource
+    replaces the station/date range it covered before, and files whose content
+    hash is unchanged are left alone."""
+    resources = iter(resources)
+    downloading, parsing = {}, {}
+    changed_stations = set()
+    total_rows = total_bytes = 0
+    started = perf_counter()
+    ## The parser processes are all forked on first use; start them before any
+    ## download thread exists, since a child forked mid-request can inherit a held lock
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=get_context("fork")) as parsers:
+        parsers.submit(int).result()
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as downloads:
+            while True:
+                while len(downloading) + len(parsing) < MAX_IN_FLIGHT:
+                    resource = next(resources, None)
+                    if resource is None:
+                        break
+                    downloading[downloads.submit(download_datafile, resource)] = resource
+                if not downloading and not parsing:
+                    break
+                done, _ = wait(tuple(downloading) + tuple(parsing), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in downloading:
+                        resource = downloading.pop(future)
+                        data, digest, download_seconds = future.result()
+                        if not data or (manifest and manifest.get(resource[1], {}).get("hash") == digest):
+                            if data:
+                                record_resource(db, resource, digest, manifest[resource[1]]["period"])
+                            continue
+                        station_id = get_station_id(db, resource[0])
+                        parsing[parsers.submit(parse_datafile, station_id, resource[0], data)] =\
+                            (resource, len(data), digest, download_seconds)
+                        continue
+                    resource, size, digest, download_seconds = parsing.pop(future)
+                    name, url, *_ = resource
+                    row_count, batches, period, parse_seconds = future.result()
+                    ## A download with no readable rows (a truncated or error page) must not
+                    ## delete what is loaded; leave it unrecorded so the next run retries it
+                    if not row_count:
+                        print(f"{url}\tno rows parsed from {size} bytes, skipped")
+                        continue
+                    copy_start = perf_counter()
+                    if manifest is not None:
+                        previous = manifest.get(url)
+                        replaced = [(name, period)]
+                        if previous:
+                            replaced.append((previous["station_name"], previous["period"]))
+                        for station_name, (first_date, last_date) in replaced:
+                            db.execute(f"""DELETE FROM {table}
+                                        WHERE station_id = %s AND ts >= %s AND ts < %s::date + 1""",
+                                       (get_station_id(db, station_name), first_date, last_date))
+                            changed_stations.add(station_name)
+                    create_partitions(db, table, period[0].year, period[1].year)
+                    copy_batches(db, table, batches)
+                    record_resource(db, resource, digest, period)
+                    changed_stations.add(name)
+                    copy_seconds = perf_counter() - copy_start
+                    print(f"{url}\t{row_count} rows\t{size} bytes\tdownload {download_seconds:.2f}s\t"
+                          f"parse {parse_seconds:.2f}s\tcopy {copy_seconds:.2f}s\t"
+                          f"{row_count / copy_seconds if copy_seconds else 0:.0f} rows/s")
+                    log_slow_ingest("aws", "resource", download_seconds + parse_seconds + copy_seconds,
+                                    resource=url, table=table, rows=row_count, bytes=size,
+                                    download=round(download_seconds, 4), parse=round(parse_seconds, 4),
+                                    copy=round(copy_seconds, 4))
+                    total_rows += row_count
+                    total_bytes += size
+    print(f"Loaded {total_rows} rows ({total_bytes} bytes) in {perf_counter() - started:.2f}s")
+    return changed_stations
+
+
+def create_station_table(db) -> None:
+    """Creates the station dimension table mapping names to small integer keys"""
+    db.execute("""CREATE TABLE IF NOT EXISTS aws_station (
+                station_id SMALLSERIAL PRIMARY KEY,
+                station_name VARCHAR(18) UNIQUE)""")
+
+
+def create_manifest_table(db) -> None:
+    """Creates the table recording which version of each resource is loaded"""
+    db.execute("""CREATE TABLE IF NOT EXISTS aws_10min_manifest (
+                url TEXT PRIMARY KEY,
+                station_name VARCHAR(18),
+                last_modified TIMESTAMP,
+                size BIGINT,
+                hash CHAR(32),
+                first_date DATE,
+                last_date DATE)""")
+
+
+def read_manifest(db) -> dict:
+    """Returns the loaded resources keyed by url"""
+    db.execute("""SELECT url, station_name, last_modified, size, hash, first_date, last_date
+                FROM aws_10min_manifest""")
+    return {url: {"station_name": station_name, "last_modified": last_modified, "size": size,
+                  "hash": digest, "period": (first_date, last_date)}
+            for url, station_name, last_modified, size, digest, first_date, last_date in db.fetchall()}
+
+
+def record_resource(db, resource: tuple, digest: str, period: tuple) -> None:
+    """Upserts a loaded resource into the manifest"""
+    name, url, last_modified, size = resource
+    db.execute("""INSERT INTO aws_10min_manifest VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (url) DO UPDATE SET
+                    station_name = EXCLUDED.station_name,
+                    last_modified = EXCLUDED.last_modified,
+                    size = EXCLUDED.size,
+                    hash = EXCLUDED.hash,
+                    first_date = EXCLUDED.first_date,
+                    last_date = EXCLUDED.last_date""",
+               (url, name, last_modified, size, digest, *period))
+
+
+def list_resources() -> tuple:
+    """Flattens the per-dataset resource lists into one tuple of resources"""
+    return tuple(resource for resource_list in get_resource_urls() or ()
+                 for resource in resource_list or ())
 
 
 def init_aws_table() -> None:
@@ -71,82 +366,181 @@ def init_aws_table() -> None:
         with postgres:
             db = postgres.cursor()
             db.execute("INSERT INTO aws_10min_last_update (last_update) VALUES (NOW()::timestamp)")
-            for resource_list in get_resource_urls():
-                formatted_data = tuple(data for resource in resource_list
-                                       for data in process_datafile(resource))
-                db.executemany("INSERT INTO aws_10min VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                               formatted_data)
-            db.execute("CREATE INDEX idx_10min_date ON aws_10min (date)")
-            db.execute("CREATE INDEX idx_10min_station ON aws_10min (station_name)")
+            ## Replace any earlier (unpartitioned) layout of the 10-minute table
+            db.execute("DROP TABLE IF EXISTS aws_10min CASCADE")
+            create_aws_table(db, "aws_10min")
+            create_station_table(db)
+            create_manifest_table(db)
+            db.execute("DELETE FROM aws_10min_manifest")
+            load_resources(db, "aws_10min", list_resources())
+            create_aws_indexes(db)
+            build_rollup_table(db)
+            build_catalog_table(db)
     except Exception as error:
         print("Error initializing AWS table.")
         print(error)
 
-def new_resources() -> bool:
-    with postgres:
-        db = postgres.cursor()
-        db.execute("SELECT last_update FROM aws_10min_last_update")
-        cutoff_date = db.fetchall()[0][0]
-    PACKAGE_SEARCH = ('https://amrdcdata.ssec.wisc.edu/api/action/package_search?q='\
-                      'title:"quality-controlled+observational+data"&sort=metadata_modified+desc&rows=1')
-    global http
-    response = http.request("GET", PACKAGE_SEARCH, retries=3)
-    results = json.loads(response.data)
-    timestamps = [resource['last_modified'] for resource in results['result']['results'][0]['resources']]
-    newest_resource = sorted(timestamps, reverse=True)[0]
-    last_modified = datetime.strptime(newest_resource, '%Y-%m-%dT%H:%M:%S.%f')
-    if last_modified > cutoff_date:
-        return True
-    
-    UPDATE_STREAM = 'https://amrdcdata.ssec.wisc.edu/api/3/action/recently_changed_packages_activity_list?limit=100'
-    response = http.request("GET", UPDATE_STREAM, retries=3)
-    results = json.loads(response.data)
-    for dataset in results['result']:
-        if 'quality-controlled observational data' in dataset['data']['package']['title']:
-            last_modified = datetime.strptime(dataset['timestamp'], '%Y-%m-%dT%H:%M:%S.%f')
-            if last_modified > cutoff_date:
-                return True
-            return False
-    
-    return False
-
-def rebuild_aws_table():
+def build_rollup_table(db, stations: list = None, table: str = "aws_10min") -> None:
+    """Summarize a 10-minute table into daily, monthly and yearly per-station rollups
+    ({table}_rollup). Each row holds the max/min of one variable with the timestamp
+    of the extreme, plus the sum and count of valid readings so means can be recombined.
+    If stations are given, only their rollup rows are recomputed."""
+    started = perf_counter()
+    rollup = f"{table}_rollup"
+    if stations is not None:
+        station_ids = [get_station_id(db, name) for name in stations]
+        db.execute(f"DELETE FROM {rollup} WHERE station_id = ANY(%s)", (station_ids,))
+        station_filter, params = "AND station_id = ANY(%s)", (station_ids,)
+    else:
+        station_filter, params = "", ()
+        db.execute(f"DROP TABLE IF EXISTS {rollup}")
+        db.execute(f"""CREATE TABLE {rollup} (
+                    period_type VARCHAR(5),
+                    station_id SMALLINT,
+                    period DATE,
+                    variable VARCHAR(14),
+                    max_value REAL,
+                    max_ts TIMESTAMP,
+                    min_value REAL,
+                    min_ts TIMESTAMP,
+                    total DOUBLE PRECISION,
+                    count INTEGER)""")
+        db.execute(f"""CREATE INDEX idx{rollup.removeprefix('aws')}
+                    ON {rollup} (period_type, variable, station_id, period)""")
+    ## Daily rollup: one pass over the 10-minute table, unpivoting each variable
+    ## and dropping missing (NULL) and 444 sentinel readings
+    observations = ", ".join(f"('{variable}', {variable})" for variable in VARIABLES)
+    db.execute(f"""INSERT INTO {rollup}
+                SELECT
+                    'day', station_id, ts::date, obs.variable,
+                    MAX(obs.value), (ARRAY_AGG(ts ORDER BY obs.value DESC, ts))[1],
+                    MIN(obs.value), (ARRAY_AGG(ts ORDER BY obs.value ASC, ts))[1],
+                    SUM(obs.value), COUNT(*)
+                FROM {table}
+                CROSS JOIN LATERAL (VALUES {observations}) AS obs(variable, value)
+                WHERE obs.value IS NOT NULL AND obs.value != 444 {station_filter}
+                GROUP BY station_id, ts::date, obs.variable""", params)
+    ## Monthly rollup from daily rows, yearly rollup from monthly rows
+    for period_type, source in (("month", "day"), ("year", "month")):
+        db.execute("""INSERT INTO {}
+                    SELECT
+                        %s, station_id, date_trunc(%s, period)::date, variable,
+                        MAX(max_value), (ARRAY_AGG(max_ts ORDER BY max_value DESC, max_ts))[1],
+                        MIN(min_value), (ARRAY_AGG(min_ts ORDER BY min_value ASC, min_ts))[1],
+                        SUM(total), SUM(count)
+                    FROM {}
+                    WHERE period_type = %s {}
+                    GROUP BY station_id, date_trunc(%s, period), variable""".format(rollup, rollup, station_filter),
+                   (period_type, period_type, source) + params + (period_type,))
+    log_slow_ingest("aws", "rollup", perf_counter() - started,
+                    stations=sorted(stations) if stations is not None else None)
+
+
+def build_catalog_table(db, stations: list = None, table: str = "aws_10min") -> None:
+    """Summarize a 10-minute table's coverage per station and year (row count and
+    first/last timestamps) into {table}_catalog for the /aws/list endpoints.
+    If stations are given, only their catalog rows are recomputed."""
+    started = perf_counter()
+    catalog = f"{table}_catalog"
+    db.execute(f"""CREATE TABLE IF NOT EXISTS {catalog} (
+                station_id SMALLINT,
+                year SMALLINT,
+                rows INTEGER,
+                first_ts TIMESTAMP,
+                last_ts TIMESTAMP,
+                PRIMARY KEY (station_id, year))""")
+    if stations is not None:
+        station_ids = [get_station_id(db, name) for name in stations]
+        db.execute(f"DELETE FROM {catalog} WHERE station_id = ANY(%s)", (station_ids,))
+        station_filter, params = "WHERE station_id = ANY(%s)", (station_ids,)
+    else:
+        db.execute(f"DELETE FROM {catalog}")
+        station_filter, params = "", ()
+    db.execute(f"""INSERT INTO {catalog}
+                SELECT station_id, date_part('year', ts), COUNT(*), MIN(ts), MAX(ts)
+                FROM {table} {station_filter}
+                GROUP BY station_id, date_part('year', ts)""", params)
+    log_slow_ingest("aws", "catalog", perf_counter() - started,
+                    stations=sorted(stations) if stations is not None else None)
+
+
+def rebuild_aws_table() -> None:
+    """Reloads every resource into a new table, indexes and summarizes it, then swaps
+    it and its rollup and catalog in for aws_10min's"""
+    try:
+        with postgres:
+            db = postgres.cursor()
+            create_aws_table(db, "aws_10min_rebuild")
+            create_station_table(db)
+            db.execute("DELETE FROM aws_10min_last_update")
+            db.execute("INSERT INTO aws_10min_last_update (last_update) VALUES (NOW()::timestamp)")
+            create_manifest_table(db)
+            db.execute("DELETE FROM aws_10min_manifest")
+            load_resources(db, "aws_10min_rebuild", list_resources())
+            create_aws_indexes(db, "aws_10min_rebuild")
+            build_rollup_table(db, table="aws_10min_rebuild")
+            build_catalog_table(db, table="aws_10min_rebuild")
+            ## The swap is only catalog changes, so the old tables stay readable
+            ## until the slow work above is done
+            db.execute("DROP TABLE IF EXISTS aws_10min, aws_10min_rollup, aws_10min_catalog")
+            db.execute("""SELECT relname, relkind FROM pg_class
+                        WHERE relname LIKE '%\\_rebuild%' AND relkind IN ('r', 'p', 'i', 'I')""")
+            for relation, kind in db.fetchall():
+                statement = "ALTER INDEX" if kind in ("i", "I") else "ALTER TABLE"
+                db.execute(f"{statement} {relation} RENAME TO {relation.replace('_rebuild', '')}")
+    except Exception as error:
+        print("Error rebuilding AWS table.")
+        print(error)
+
+
+def update_aws_table() -> None:
+    """Compares the repository's resources against aws_10min_manifest and replaces
+    only the station/date ranges of new, changed or removed resources, in a single
+    transaction. Falls back to a full rebuild if there is no manifest yet."""
     try:
-        if new_resources():
-            print("New resources available from data repo")
-            with postgres:
-                db = postgres.cursor()
-                db.execute("""CREATE TABLE aws_10min_rebuild (
-                            station_name VARCHAR(18),
-                            date DATE,
-                            time TIME,
-                            temperature REAL,
-                            pressure REAL,
-                            wind_speed REAL,
-                            wind_direction REAL,
-                            humidity REAL,
-                            delta_t REAL)""")
+        with postgres:
+            db = postgres.cursor()
+            create_manifest_table(db)
+            manifest = read_manifest(db)
+        if not manifest:
+            print("No resource manifest found, rebuilding AWS table")
+            rebuild_aws_table()
+            return
+        resources = list_resources()
+        if not resources:
+            print("No resources listed by data repo")
+            return
+        changed = tuple(resource for resource in resources
+                        if resource[1] not in manifest
+                        or (manifest[resource[1]]["last_modified"], manifest[resource[1]]["size"])
+                           != (resource[2], resource[3])
+                        or None in resource[2:])
+        removed = set(manifest) - {resource[1] for resource in resources}
+        if not changed and not removed:
+            print("No new resources available from data repo")
+            return
+        print(f"{len(changed)} new or changed and {len(removed)} removed resources in data repo")
+        with postgres:
+            db = postgres.cursor()
+            stations = load_resources(db, "aws_10min", changed, manifest)
+            for url in removed:
+                previous = manifest[url]
+                db.execute("""DELETE FROM aws_10min
+                            WHERE station_id = %s AND ts >= %s AND ts < %s::date + 1""",
+                           (get_station_id(db, previous["station_name"]), *previous["period"]))
+                db.execute("DELETE FROM aws_10min_manifest WHERE url = %s", (url,))
+                stations.add(previous["station_name"])
+            if stations:
+                build_rollup_table(db, stations)
+                build_catalog_table(db, stations)
                 db.execute("DELETE FROM aws_10min_last_update")
                 db.execute("INSERT INTO aws_10min_last_update (last_update) VALUES (NOW()::timestamp)")
-                for resource_list in get_resource_urls():
-                    formatted_data = tuple(data for resource in resource_list
-                                        for data in process_datafile(resource))
-                    db.executemany("INSERT INTO aws_10min_rebuild VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                                formatted_data)
-                db.execute("DROP TABLE aws_10min")
-                db.execute("DROP INDEX IF EXISTS idx_10min_date")
-                db.execute("DROP INDEX IF EXISTS idx_10min_station")
-                db.execute("ALTER TABLE aws_10min_rebuild RENAME TO aws_10min")
-                db.execute("CREATE INDEX idx_10min_date ON aws_10min (date)")
-                db.execute("CREATE INDEX idx_10min_station ON aws_10min (station_name)")
-        else:
-            print("No new resources available from data repo")
     except Exception as error:
-        print("Error rebuilding AWS table.")
+        print("Error updating AWS table.")
         print(error)
 
 if __name__ == "__main__":
     print(f"{datetime.now()}\tStarting AWS database update")
-    rebuild_aws_table()
+    update_aws_table()
     print(f"{datetime.now()}\tDone")
     test.test_db()
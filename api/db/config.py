@@ -1,4 +1,6 @@
-from os import environ
+from os import environ, getpid
+from datetime import datetime
+import json
 import psycopg2
 
 ## Set DB credentials
@@ -13,3 +15,22 @@ postgres = psycopg2.connect(
     password=DB_PASSWORD,
     host=DB_HOST,
     port=DB_PORT)
+
+## Loader steps slower than SLOW_INGEST_SECONDS are appended to the API's slow query
+## log (JSON lines, see api/slow_log.py and dev/slow_queries.py)
+SLOW_QUERY_LOG = environ.get("SLOW_QUERY_LOG", "/tmp/amrdc_slow_queries.jsonl")
+SLOW_INGEST_SECONDS = float(environ.get("SLOW_INGEST_SECONDS", 10))
+
+def log_slow_ingest(loader: str, step: str, seconds: float, **details) -> None:
+    """Appends a slow loader step (e.g. one resource's download, parse and COPY)
+    to SLOW_QUERY_LOG if it took longer than SLOW_INGEST_SECONDS"""
+    if not 0 < SLOW_INGEST_SECONDS <= seconds:
+        return
+    entry = {"time": datetime.now().isoformat(timespec="seconds"), "kind": "ingest", "pid": getpid(),
+             "loader": loader, "step": step, "seconds": round(seconds, 4), **details}
+    try:
+        with open(SLOW_QUERY_LOG, "a") as log:
+            log.write(json.dumps(entry, default=str) + "\n")
+    except OSError as error:
+        print("Error writing slow query log")
+        print(error)
@@ -1,10 +1,33 @@
 """Initialize/update the realtime database tables for the AMRDC AWS API"""
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 import urllib3
-from config import postgres
+import numpy as np
+from psycopg2.extras import execute_values
+from config import postgres, log_slow_ingest
+
+## Station files are fetched concurrently with a per-request timeout, so one slow
+## or dead station only costs its own timeout instead of stretching the whole job
+FETCH_WORKERS = 16
+FETCH_TIMEOUT = urllib3.Timeout(connect=5.0, read=30.0)
+FETCH_RETRIES = urllib3.Retry(total=2, backoff_factor=1)
 
 ## Define HTTP connection pool manager
-http = urllib3.PoolManager()
+http = urllib3.PoolManager(maxsize=FETCH_WORKERS)
+
+## Rows per INSERT statement when upserting observations
+UPSERT_PAGE_SIZE = 1000
+
+READINGS = ("temperature", "pressure", "wind_speed", "wind_direction", "humidity")
+
+## Datafile lines: ARGOS ID, YYYYDDD date, HHMMSS time, the READINGS and two unused
+## columns. The first two lines of that shape are headers. 444 marks a missing reading.
+DATAFILE_COLUMNS = 10
+MISSING = 444
+
+## Calendar windows tracked in aws_realtime_aggregate (named as in date_trunc)
+WINDOWS = ("day", "week", "month")
 
 ## Hardcoded ARGOS AWS metadata:
 ## (ARGOS ID#, Station Name, Antarctic Region)
@@ -57,69 +80,72 @@ def get_data_url(argos_id: str):
     return f"http://amrc.ssec.wisc.edu/data/surface/awstext/{argos_id}.txt"
 
 
-def read_data(url: str) -> list | None:
-    """Access data via AMRC URL and return the most recent datapoint"""
+def read_data(url: str, validators: tuple = None) -> tuple:
+    """Conditionally GET an AMRC datafile using the (ETag, Last-Modified) validators
+    from the previous fetch. Returns (data, validators); data is None if the file
+    is unchanged or could not be read."""
+    headers = {}
+    etag, last_modified = validators or (None, None)
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
     try:
-        global http
-        datafile = http.request("GET", url, retries=5)
-        data = datafile.data.decode('utf-8').strip().split('\n')
-        table = [line.split()[1:] for line in data if len(line.split()) == 10][2:]
-        return table if table else None
+        datafile = http.request("GET", url, headers=headers,
+                                retries=FETCH_RETRIES, timeout=FETCH_TIMEOUT)
+        if datafile.status == 304:
+            return None, validators
+        if datafile.status != 200:
+            raise Exception(f"HTTP status {datafile.status}")
+        return datafile.data, (datafile.headers.get("ETag"), datafile.headers.get("Last-Modified"))
     except Exception as error:
         print(f"Could not read datafile: {url}")
         print(error)
+        return None, validators
 
 
-def process_datapoint(station_name: str, region: str, data: list) -> dict:
-    """Formats a row of data into our database schema dict"""
+def read_table(data: bytes) -> np.ndarray:
+    """Reads the date, time and READINGS columns of a datafile's data lines into a
+    float64 array in one pass. Non-numeric lines are dropped."""
+    lines = [line for line in data.decode('utf-8').split('\n')
+             if len(line.split()) == DATAFILE_COLUMNS][2:]
     try:
-        date_str, time, temp, press, wind_spd, wind_dir, hum, _, _ = data   # Unpack datapoint
-        standard_date = datetime.strptime(date_str, '%Y%j').date()
-        standard_time = datetime.strptime(time, '%H%M%S').time()
-        params = {
-            "station_name": station_name,
-            "date": standard_date,
-            "time": standard_time,
-            "temperature": float(temp),
-            "pressure": float(press),
-            "wind_speed": float(wind_spd),
-            "wind_direction": int(wind_dir),
-            "humidity": float(hum),
-            "region": region
-        }
-        return params
-    except Exception as e:
-        print(f"Could not process datapoint: {station_name}\n{data}")
-        print(e)
-        return None
+        return np.loadtxt(lines, usecols=range(1, 8), ndmin=2).reshape(-1, 7)
+    except ValueError:
+        rows = []
+        for line in lines:
+            try:
+                rows.append([float(token) for token in line.split()[1:8]])
+            except ValueError:
+                continue
+        return np.array(rows, dtype=np.float64).reshape(-1, 7)
 
-def init_realtime_table():
+
+def process_datafile(station_name: str, region: str, data: bytes) -> list:
+    """Formats a datafile into aws_realtime row dicts, converting dates and times
+    column-wise. Repeated observations collapse to the last one."""
     try:
-        for (aws, station_name, region) in ARGOS:
-            data = read_data(get_data_url(aws))
-            if data:
-                params = tuple(process_datapoint(station_name, region, row) for row in data)
-                with postgres:
-                    db = postgres.cursor()
-                    for row in (row for row in params if row is not None):
-                        db.execute("""INSERT INTO aws_realtime VALUES (%(station_name)s,
-                                                                    %(date)s,
-                                                                    %(time)s,
-                                                                    %(temperature)s,
-                                                                    %(pressure)s,
-                                                                    %(wind_speed)s,
-                                                                    %(wind_direction)s,
-                                                                    %(humidity)s,
-                                                                    %(region)s)""", row)
+        table = read_table(data)
+        day, time = table[:, 0].astype(np.int64), table[:, 1].astype(np.int64)
+        dates = (day // 1000 - 1970).astype("M8[Y]").astype("M8[D]") + (day % 1000 - 1).astype("m8[D]")
+        seconds = time // 10000 * 3600 + time // 100 % 100 * 60 + time % 100
+        timestamps = (dates.astype("M8[s]") + seconds.astype("m8[s]")).tolist()
+        readings = table[:, 2:].astype(object)
+        readings[table[:, 2:] == MISSING] = None
+        rows = {}
+        for timestamp, values in zip(timestamps, readings.tolist()):
+            rows[timestamp] = {"station_name": station_name, "date": timestamp.date(),
+                               "time": timestamp.time(), "region": region,
+                               **dict(zip(READINGS, values))}
+        return list(rows.values())
     except Exception as e:
-        print("Error initializing realtime database")
+        print(f"Could not process datafile: {station_name}")
         print(e)
+        return []
 
-def rebuild_realtime_table():
-    try:
-        with postgres:
-            db = postgres.cursor()
-            db.execute("""CREATE TABLE aws_realtime_rebuild (station_name VARCHAR(18),
+def create_realtime_tables(db) -> None:
+    """Creates aws_realtime, its (station, date, time) key and the fetch state table"""
+    db.execute("""CREATE TABLE IF NOT EXISTS aws_realtime (station_name VARCHAR(18),
                                                     date DATE,
                                                     time TIME,
                                                     temperature REAL,
@@ -128,27 +154,182 @@ def rebuild_realtime_table():
                                                     wind_direction REAL,
                                                     humidity REAL,
                                                     region VARCHAR(24))""")
-            for (aws, station_name, region) in ARGOS:
-                data = read_data(get_data_url(aws))
-                if data:
-                    params = tuple(process_datapoint(station_name, region, row) for row in data)
-                    for row in (row for row in params if row is not None):
-                        db.execute("""INSERT INTO aws_realtime_rebuild VALUES (%(station_name)s,
-                                                                            %(date)s,
-                                                                            %(time)s,
-                                                                            %(temperature)s,
-                                                                            %(pressure)s,
-                                                                            %(wind_speed)s,
-                                                                            %(wind_direction)s,
-                                                                            %(humidity)s,
-                                                                            %(region)s)""", row)
-            db.execute("DROP TABLE aws_realtime")
-            db.execute("ALTER TABLE aws_realtime_rebuild RENAME TO aws_realtime")
+    db.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'idx_realtime_station_ts'")
+    if not db.fetchone():
+        ## Tables built by the old drop-and-reload job may hold duplicate observations
+        db.execute("""DELETE FROM aws_realtime a USING aws_realtime b
+                    WHERE a.ctid < b.ctid AND a.station_name = b.station_name
+                    AND a.date = b.date AND a.time = b.time""")
+        db.execute("""CREATE UNIQUE INDEX idx_realtime_station_ts
+                    ON aws_realtime (station_name, date, time)""")
+    db.execute("""CREATE TABLE IF NOT EXISTS aws_realtime_fetch (url TEXT PRIMARY KEY,
+                                                             etag TEXT,
+                                                             last_modified TEXT)""")
+    db.execute("CREATE TABLE IF NOT EXISTS aws_realtime_last_update (last_update TIMESTAMP)")
+    db.execute("""CREATE TABLE IF NOT EXISTS aws_realtime_aggregate (window_type VARCHAR(5),
+                                                                 period DATE,
+                                                                 station_name VARCHAR(18),
+                                                                 variable VARCHAR(14),
+                                                                 max_value REAL,
+                                                                 max_date DATE,
+                                                                 max_time TIME,
+                                                                 min_value REAL,
+                                                                 min_date DATE,
+                                                                 min_time TIME,
+                                                                 PRIMARY KEY (window_type, period,
+                                                                              station_name, variable))""")
+    db.execute("SELECT 1 FROM aws_realtime_aggregate LIMIT 1")
+    if not db.fetchone():
+        ## Seed new aggregates from the observations already in aws_realtime
+        db.execute(f"SELECT station_name, date, time, {', '.join(READINGS)} FROM aws_realtime")
+        update_aggregates(db, db.fetchall())
+
+
+def window_start(window: str, day: date) -> date:
+    """First day of the calendar day/week (Monday)/month window containing day"""
+    match window:
+        case "day":
+            return day
+        case "week":
+            return day - timedelta(days=day.weekday())
+        case "month":
+            return day.replace(day=1)
+
+
+def update_aggregates(db, rows: list, windows: tuple = WINDOWS) -> None:
+    """Folds new (station_name, date, time, *readings) rows into the per-station max/min
+    of each calendar window in aws_realtime_aggregate. Only the given rows are read, so
+    each update costs O(new rows). Missing (NULL) and 444 sentinel readings are skipped."""
+    extremes = {}
+    for station_name, day, time, *readings in rows:
+        for window in windows:
+            period = window_start(window, day)
+            for variable, value in zip(READINGS, readings):
+                if value is None or value == 444:
+                    continue
+                extreme = extremes.get((window, period, station_name, variable))
+                if extreme is None:
+                    extremes[(window, period, station_name, variable)] = [value, day, time, value, day, time]
+                    continue
+                if value > extreme[0]:
+                    extreme[0:3] = value, day, time
+                if value < extreme[3]:
+                    extreme[3:6] = value, day, time
+    if not extremes:
+        return
+    execute_values(db, """INSERT INTO aws_realtime_aggregate AS agg VALUES %s
+                        ON CONFLICT (window_type, period, station_name, variable) DO UPDATE SET
+                        max_value = GREATEST(agg.max_value, EXCLUDED.max_value),
+                        max_date = CASE WHEN EXCLUDED.max_value > agg.max_value
+                                   THEN EXCLUDED.max_date ELSE agg.max_date END,
+                        max_time = CASE WHEN EXCLUDED.max_value > agg.max_value
+                                   THEN EXCLUDED.max_time ELSE agg.max_time END,
+                        min_value = LEAST(agg.min_value, EXCLUDED.min_value),
+                        min_date = CASE WHEN EXCLUDED.min_value < agg.min_value
+                                   THEN EXCLUDED.min_date ELSE agg.min_date END,
+                        min_time = CASE WHEN EXCLUDED.min_value < agg.min_value
+                                   THEN EXCLUDED.min_time ELSE agg.min_time END""",
+                   [key + tuple(extreme) for key, extreme in extremes.items()],
+                   page_size=UPSERT_PAGE_SIZE)
+    ## Keep the current and previous month of windows
+    db.execute("""DELETE FROM aws_realtime_aggregate
+                WHERE period < (SELECT MAX(period) FROM aws_realtime_aggregate
+                                WHERE window_type = 'month') - INTERVAL '1 month'""")
+
+
+def revise_aggregates(db, rows: list) -> None:
+    """Recomputes the windows holding revised (station_name, date, time, *readings) rows
+    from aws_realtime, since folding a corrected reading in can widen a window's max/min
+    but never narrow it. A window that starts before the station's oldest row in
+    aws_realtime has already been partly pruned, so it cannot be recomputed; the
+    revised rows are folded into it instead and a replaced extreme stays."""
+    affected = {(window, window_start(window, day), station_name)
+                for station_name, day, *_ in rows for window in WINDOWS}
+    for window, period, station_name in sorted(affected):
+        db.execute("SELECT MIN(date) FROM aws_realtime WHERE station_name = %s", (station_name,))
+        oldest = db.fetchone()[0]
+        if oldest is None or oldest >= period:
+            update_aggregates(db, [row for row in rows if row[0] == station_name
+                                   and window_start(window, row[1]) == period], (window,))
+            continue
+        db.execute("""DELETE FROM aws_realtime_aggregate
+                    WHERE window_type = %s AND period = %s AND station_name = %s""",
+                   (window, period, station_name))
+        db.execute(f"""SELECT station_name, date, time, {', '.join(READINGS)} FROM aws_realtime
+                    WHERE station_name = %s AND date >= %s AND date < %s::date + ('1 ' || %s)::interval""",
+                   (station_name, period, period, window))
+        update_aggregates(db, db.fetchall(), (window,))
+
+
+def upsert_observations(db, rows: list) -> list:
+    """Inserts new observations; existing ones are only rewritten if a reading changed.
+    Returns the inserted or changed rows as (station_name, date, time, *readings, revised),
+    revised being true for rows that replaced an earlier observation."""
+    readings = ", ".join(READINGS)
+    excluded = ", ".join(f"EXCLUDED.{reading}" for reading in READINGS)
+    current = ", ".join(f"aws_realtime.{reading}" for reading in READINGS)
+    template = ", ".join(f"%({column})s" for column in ("station_name", "date", "time") + READINGS + ("region",))
+    return execute_values(db, f"""INSERT INTO aws_realtime (station_name, date, time, {readings}, region)
+                        VALUES %s
+                        ON CONFLICT (station_name, date, time) DO UPDATE
+                        SET ({readings}, region) = ({excluded}, EXCLUDED.region)
+                        WHERE ({current}) IS DISTINCT FROM ({excluded})
+                        RETURNING station_name, date, time, {readings}, xmax <> 0""",
+                   rows, template=f"({template})", page_size=UPSERT_PAGE_SIZE, fetch=True)
+
+
+def update_realtime_table():
+    """Fetches every station file concurrently, skipping files unchanged since the last
+    run, and upserts their observations into aws_realtime in one transaction. Rows older
+    than a station's current file are pruned, so the table keeps the files' rolling window
+    without ever being dropped. New observations are folded into aws_realtime_aggregate."""
+    try:
+        with postgres:
+            db = postgres.cursor()
+            create_realtime_tables(db)
+            db.execute("SELECT url, etag, last_modified FROM aws_realtime_fetch")
+            validators = {url: (etag, last_modified) for url, etag, last_modified in db.fetchall()}
+        urls = [get_data_url(aws) for (aws, _, _) in ARGOS]
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            results = list(executor.map(lambda url: read_data(url, validators.get(url)), urls))
+        updated = 0
+        with postgres:
+            db = postgres.cursor()
+            for (_, station_name, region), url, (data, file_validators) in zip(ARGOS, urls, results):
+                if data is None:
+                    continue
+                started = perf_counter()
+                rows = process_datafile(station_name, region, data)
+                if not rows:
+                    continue
+                oldest = min(rows, key=lambda row: (row["date"], row["time"]))
+                db.execute("""DELETE FROM aws_realtime
+                            WHERE station_name = %s AND (date, time) < (%s, %s)""",
+                           (station_name, oldest["date"], oldest["time"]))
+                changed = upsert_observations(db, rows)
+                update_aggregates(db, [row[:-1] for row in changed if not row[-1]])
+                revise_aggregates(db, [row[:-1] for row in changed if row[-1]])
+                db.execute("""INSERT INTO aws_realtime_fetch (url, etag, last_modified)
+                            VALUES (%s, %s, %s)
+                            ON CONFLICT (url) DO UPDATE
+                            SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified""",
+                           (url, *file_validators))
+                log_slow_ingest("realtime", "station", perf_counter() - started,
+                                resource=url, station=station_name, rows=len(rows))
+                updated += 1
+            ## Drop stations no longer listed in ARGOS
+            db.execute("DELETE FROM aws_realtime WHERE station_name != ALL(%s)",
+                       ([station_name for (_, station_name, _) in ARGOS],))
+            if updated or db.rowcount:
+                ## Bumping the version invalidates the API's realtime snapshot
+                db.execute("DELETE FROM aws_realtime_last_update")
+                db.execute("INSERT INTO aws_realtime_last_update (last_update) VALUES (NOW()::timestamp)")
+        print(f"{updated} of {len(ARGOS)} station files updated")
     except Exception as e:
-        print("Error rebuilding realtime database")
+        print("Error updating realtime database")
         print(e)
 
 if __name__ == "__main__":
     print(f"{datetime.now()}\tStarting realtime database update")
-    rebuild_realtime_table()
+    update_realtime_table()
     print(f"{datetime.now()}\tDone")
@@ -1,7 +1,14 @@
 from unittest import TestCase, TestResult, TestLoader, TextTestRunner, main as test_all
 from typing import Tuple
+from os.path import abspath, dirname, join
+from datetime import datetime, timedelta
+import sys
 from config import postgres
 
+## api_tools lives in the API directory above this one
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+from api_tools import generate_query, typed_query, INTERVALS, JSON_FORMATS
+
 ##########################
 ## api_tools unit tests ##
 ##########################
@@ -18,35 +25,143 @@ class TestAWS(TestCase):
     def test_queries(self):
         ## aws_10min Tests
         aws_10min_schema = {'header': ('column_name', 'data_type'),
-                            'data':   [('delta_t', 'real'), 
-                                       ('date', 'date'),
-                                       ('time', 'time without time zone'),
+                            'data':   [('station_id', 'smallint'),
+                                       ('ts', 'timestamp without time zone'),
+                                       ('interval_bucket', 'smallint'),
                                        ('temperature', 'real'),
                                        ('pressure', 'real'),
                                        ('wind_speed', 'real'),
                                        ('wind_direction', 'real'),
                                        ('humidity', 'real'),
-                                       ('station_name', 'character varying')]}
+                                       ('delta_t', 'real')]}
         schema_query = """select column_name, data_type from information_schema.columns
-                          where table_name = 'aws_10min'"""
+                          where table_name = 'aws_10min' order by ordinal_position"""
         self.assertEqual(query_database(schema_query), aws_10min_schema)
+        ## aws_10min must be partitioned by year
+        partitioned = query_database("SELECT relkind FROM pg_class WHERE relname = 'aws_10min'")
+        self.assertEqual(partitioned['data'], [('p',)])
 
         count = query_database("SELECT COUNT(*) FROM aws_10min")
         self.assertTrue(count['data'][0][0] != 0)
 
-        stations_list = query_database("SELECT DISTINCT(station_name) FROM aws_10min ORDER BY station_name")
+        stations_list = query_database("""SELECT DISTINCT(station_name) FROM aws_10min
+                                          JOIN aws_station USING (station_id) ORDER BY station_name""")
         self.assertTrue(stations_list['data'] != [])
-        years_list = query_database("SELECT DISTINCT(date_part('year', date)) as date FROM aws_10min ORDER BY date")
+        years_list = query_database("SELECT DISTINCT(date_part('year', ts)) as date FROM aws_10min ORDER BY date")
         self.assertTrue(years_list['data'] != [])
 
-        test_result = query_database("""SELECT * FROM aws_10min
-                                        WHERE station_name = 'Byrd' 
-                                        AND to_char(date, 'YYYYMMDD') = '20160101'""")
+        test_result = query_database("""SELECT aws_10min.* FROM aws_10min
+                                        JOIN aws_station USING (station_id)
+                                        WHERE station_name = 'Byrd'
+                                        AND ts >= '2016-01-01' AND ts < '2016-01-02'""")
         self.assertEqual(len(test_result), 2)
-        header = ('station_name', 'date', 'time', 'temperature', 'pressure', 'wind_speed', 'wind_direction', 'humidity', 'delta_t')
+        header = ('station_id', 'ts', 'interval_bucket', 'temperature', 'pressure', 'wind_speed', 'wind_direction', 'humidity', 'delta_t')
         self.assertEqual(test_result['header'], header)
         self.assertTrue(test_result['data'] != [])
 
+class TestRollup(TestCase):
+    def test_queries(self):
+        ## aws_10min_rollup tests
+        period_types = query_database("SELECT DISTINCT(period_type) FROM aws_10min_rollup ORDER BY period_type")
+        self.assertEqual(period_types['data'], [('day',), ('month',), ('year',)])
+        ## Every station in aws_10min should have a yearly rollup
+        missing = query_database("""SELECT DISTINCT(station_id) FROM aws_10min
+                                    EXCEPT SELECT station_id FROM aws_10min_rollup
+                                    WHERE period_type = 'year'""")
+        self.assertEqual(missing['data'], [])
+        ## Rolled-up counts must add up to the daily counts
+        counts = query_database("""SELECT period_type, SUM(count) FROM aws_10min_rollup
+                                   WHERE variable = 'temperature' GROUP BY period_type""")
+        self.assertEqual(len(set(total for _, total in counts['data'])), 1)
+
+class TestCatalog(TestCase):
+    def test_queries(self):
+        ## aws_10min_catalog must cover every row of aws_10min
+        catalog = query_database("SELECT SUM(rows) FROM aws_10min_catalog")
+        total = query_database("SELECT COUNT(*) FROM aws_10min")
+        self.assertEqual(catalog['data'][0][0], total['data'][0][0])
+        misplaced = query_database("""SELECT * FROM aws_10min_catalog
+                                      WHERE date_part('year', first_ts) != year
+                                      OR date_part('year', last_ts) != year""")
+        self.assertEqual(misplaced['data'], [])
+
+class TestQueryPlans(TestCase):
+    def plan_nodes(self, query: str, args: Tuple = ()) -> list:
+        plan = query_database("EXPLAIN (FORMAT JSON) " + query, args)['data'][0][0][0]['Plan']
+        return self.subplan_nodes(plan)
+
+    def subplan_nodes(self, node: dict) -> list:
+        ## The node and all of its descendants
+        nodes, pending = [], [node]
+        while pending:
+            node = pending.pop()
+            nodes.append(node)
+            pending.extend(node.get('Plans', []))
+        return nodes
+
+    def test_interval_index(self):
+        ## `all` queries as built by generate_query must read aws_10min through the
+        ## (station_id, interval_bucket, ts) index (or its partitions' copies) instead of
+        ## scanning and filtering every reading: over a week for every interval, and over
+        ## the whole record for the coarser intervals
+        interval_indexes = {index for (index,) in query_database(
+            """SELECT indexname FROM pg_indexes WHERE tablename LIKE 'aws_10min%%'
+               AND indexdef LIKE '%%(station_id, interval_bucket, ts)'""")['data']}
+        self.assertTrue(interval_indexes)
+        station, first_ts = query_database("""SELECT station_name, first_ts FROM aws_10min_catalog
+                                              JOIN aws_station USING (station_id)
+                                              ORDER BY rows DESC LIMIT 1""")['data'][0]
+        ranges = [(interval, first_ts, first_ts + timedelta(days=6)) for interval in INTERVALS]
+        ranges += [(interval, datetime(1900, 1, 1), datetime(9999, 12, 30)) for interval in INTERVALS[:-1]]
+        for interval, startdate, enddate in ranges:
+            query, params = generate_query("all", (station,), interval, startdate, enddate,
+                                           None, None, False)
+            nodes = self.plan_nodes(query.as_string(None), params)
+            scans = [node for node in nodes if node.get('Relation Name', '').startswith('aws_10min_y')]
+            self.assertTrue(scans, (interval, startdate))
+            for scan in scans:
+                self.assertNotEqual(scan['Node Type'], 'Seq Scan', (interval, startdate))
+                ## A Bitmap Heap Scan names its index on its Bitmap Index Scan children
+                indexes = {node.get('Index Name') for node in self.subplan_nodes(scan)}
+                self.assertTrue(indexes & interval_indexes, (interval, startdate, indexes))
+
+class TestDownloads(TestCase):
+    def test_csv_values(self):
+        ## CSV downloads are built as text whatever the JSON format asked for, since
+        ## serve_csv joins the row values as strings
+        station = query_database("""SELECT station_name FROM aws_10min_catalog
+                                    JOIN aws_station USING (station_id) LIMIT 1""")
+        for format in JSON_FORMATS:
+            self.assertFalse(typed_query(format, download=True))
+            query, params = generate_query("all", (station['data'][0][0],), 10, datetime(1900, 1, 1),
+                                           datetime(9999, 12, 30), None, None, True,
+                                           typed=typed_query(format, download=True))
+            result = query_database(query.as_string(None) + " LIMIT 100", params)
+            self.assertTrue(result['data'])
+            for row in result['data']:
+                self.assertTrue(all(value is None or isinstance(value, str) for value in row))
+
+    def test_all_station_extremes(self):
+        ## The overall max/min reading of all stations, downloaded as CSV
+        for query_type in ("max", "min"):
+            query, params = generate_query(query_type, ("all",), 10, datetime(1900, 1, 1),
+                                           datetime(9999, 12, 30), "temperature", "station", True,
+                                           typed=typed_query("json", download=True))
+            result = query_database(query.as_string(None), params)
+            self.assertEqual(len(result['data']), 1)
+            self.assertTrue(all(value is None or isinstance(value, str) for value in result['data'][0]))
+
+    def test_all_station_mean(self):
+        ## The overall mean of all stations, downloaded as CSV, rounded like the other means
+        query, params = generate_query("mean", ("all",), 10, datetime(1900, 1, 1),
+                                       datetime(9999, 12, 30), "temperature", "station", True,
+                                       typed=typed_query("json", download=True))
+        result = query_database(query.as_string(None), params)
+        self.assertEqual(len(result['data']), 1)
+        (mean,) = result['data'][0]
+        self.assertIsInstance(mean, str)
+        self.assertEqual(float(mean), round(float(mean), 2))
+
 class TestRealtime(TestCase):
     def test_queries(self):
         ## aws_realtime tests
@@ -71,6 +186,10 @@ class TestRealtime(TestCase):
 
 def test_db():
     suite = TestLoader().loadTestsFromTestCase(TestAWS)
+    suite.addTests(TestLoader().loadTestsFromTestCase(TestRollup))
+    suite.addTests(TestLoader().loadTestsFromTestCase(TestCatalog))
+    suite.addTests(TestLoader().loadTestsFromTestCase(TestQueryPlans))
+    suite.addTests(TestLoader().loadTestsFromTestCase(TestDownloads))
     runner = TextTestRunner()
     runner.run(suite)
     
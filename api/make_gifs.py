@@ -1,10 +1,38 @@
 import urllib3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, date, timedelta
+from hashlib import sha256
 from io import BytesIO
-from PIL import Image
+from os import environ, getpid, makedirs, remove, replace, scandir
+from os.path import exists, join
+from urllib.parse import quote
+import orjson
+from PIL import Image, features
+
+## THREDDS server hosting the satellite composites
+THREDDS_URL = 'https://amrdcdata.ssec.wisc.edu/thredds'
+
+## Catalogs and images are fetched concurrently; size the HTTP pool to match
+FETCH_WORKERS = 12
 
 ## Define HTTP connection pool manager
-http = urllib3.PoolManager()
+http = urllib3.PoolManager(maxsize=FETCH_WORKERS, retries=urllib3.Retry(total=5, backoff_factor=0.5))
+
+## Frames per animated GIF. Processed frames (quantized and resized) are cached on
+## disk keyed by image URL, so each run only downloads and processes frames it has
+## not seen before; frames that drop out of every channel's window are evicted.
+FRAMES = 12
+FRAME_CACHE_DIR = environ.get("FRAME_CACHE_DIR", "/api/gif_frames")
+GIF_DIR = "/api/static"
+
+## Each animation is published under a content-hashed name ({channel}.{hash}.gif),
+## which the API serves as immutable, and under its plain name for older clients.
+## The manifest maps channels to their current hashed files; the previous
+## generation is kept so clients holding an older manifest can still fetch it.
+## Animated WebP (lossless, so frames are identical to the GIF's) is published
+## alongside when Pillow has WebP support.
+MANIFEST = "gifs.json"
+HASH_LENGTH = 12
 
 def harvest_gif_images() -> list:
     today = date.today().strftime("%Y/%m%d")                                    ## Get today and yesterday's date
@@ -17,64 +45,166 @@ def harvest_gif_images() -> list:
         ('Visible', 'sat4kmvisiblegif'),
         ('Water Vapor', 'sat4kmwatervaporgif')
     )
-    urls = []                                                                   ## Container to store channel image urls
     def get_image_url(url: str):
         try:
-            global http
-            datafile = http.request("GET", url, retries=5)
+            datafile = http.request("GET", url)
             image_catalog = datafile.data.decode('utf-8').split('\n')                                      ## Access the catalog XML file and read
             image_catalog = [line.strip() for line in image_catalog             ## Locate the urls for the small .jpgs
                             if 'urlPath' in line and 'small' in line]
             image_catalog = [word.split('"')[1]                                 ## Extract just the file extension
-                            for line in image_catalog 
+                            for line in image_catalog
                             for word in line.split() if 'urlPath' in word]
-            ##latest_image = image_catalog[-1]
-            url = 'https://amrdcdata.ssec.wisc.edu/thredds/fileServer/'         ## This is the THREDDS file server host URL
+            url = f'{THREDDS_URL}/fileServer/'                                  ## This is the THREDDS file server host URL
             return [f'{url}{image}' for image in image_catalog]                 ## Return the formatted string
         except Exception:
             return []
-    for (key, value) in spec_channels:                                          ## Do this for each channel
-        channel_urls = []
-        two_days_ago_images = get_image_url(
-            f'https://amrdcdata.ssec.wisc.edu/thredds/catalog/{value}/{two_days_ago}/catalog.xml'
-            )
-        channel_urls += two_days_ago_images
-        yesterday_images = get_image_url(                                       ## Using yesterday's date,
-            f'https://amrdcdata.ssec.wisc.edu/thredds/catalog/{value}/{yesterday}/catalog.xml'
-            )
-        channel_urls += yesterday_images
-        latest_images = get_image_url(                                          ## And today's date.
-            f'https://amrdcdata.ssec.wisc.edu/thredds/catalog/{value}/{today}/catalog.xml'
-            )
-        channel_urls += latest_images                                           ## We add them to the end of the channel url container
-        urls.append((key, channel_urls[-12:]))                                  ## Then append the most recent 12 to our list
+    catalogs = [f'{THREDDS_URL}/catalog/{value}/{day}/catalog.xml'            ## Two days ago, yesterday and today
+                for (key, value) in spec_channels                               ## for each channel, oldest first
+                for day in (two_days_ago, yesterday, today)]
+    with ThreadPoolExecutor(FETCH_WORKERS) as fetchers:                         ## Fetch all 15 catalogs at once
+        images = list(fetchers.map(get_image_url, catalogs))
+    urls = []                                                                   ## Container to store channel image urls
+    for index, (key, value) in enumerate(spec_channels):
+        channel_urls = [url for day_images in images[3 * index:3 * index + 3]   ## Join the channel's three days
+                        for url in day_images]
+        urls.append((key, channel_urls[-FRAMES:]))                              ## Then append the most recent 12 to our list
     return urls
 
+def get_web_image(url: str) -> bytes | None:
+    try:
+        return http.request("GET", url).data
+    except Exception as error:
+        print("Error downloading frame: " + url)
+        print(error)
+        return None
+
+def process_frame(channel: str, data: bytes) -> bytes:                          ## Runs in a worker process
+    img = Image.open(BytesIO(data))
+    if channel == "Water Vapor":                                                ## Quantize colors for compression: 32 bit for WV,
+        img = img.quantize(colors=32)
+    else:
+        img = img.quantize(colors=16)                                           ## 16 bit for all others (primarily grayscale)
+    img = img.resize((350, 350), resample=Image.LANCZOS)
+    out = BytesIO()
+    img.save(out, 'GIF')
+    return out.getvalue()                                                       ## Return the resized and compressed image
+
+def frame_path(url: str) -> str:
+    return join(FRAME_CACHE_DIR, sha256(url.encode()).hexdigest() + '.gif')
+
+def save_frame(url: str, frame: bytes) -> None:
+    partial = f"{frame_path(url)}.{getpid()}"                                   ## Write then rename, so a frame is never
+    with open(partial, "wb") as out:                                            ## cached half-written
+        out.write(frame)
+    replace(partial, frame_path(url))
+
+def update_frame_cache(sat_images) -> set:
+    ## Download and process the frames missing from the cache. Returns the URLs
+    ## of the frames added.
+    makedirs(FRAME_CACHE_DIR, exist_ok=True)
+    new_frames = [(channel, url) for channel, urls in sat_images for url in urls
+                  if not exists(frame_path(url))]
+    added = set()
+    ## The worker processes are forked on first use; start them before any fetch
+    ## thread exists, since a child forked mid-request can inherit a held lock
+    with ProcessPoolExecutor() as processors:
+        processors.submit(int).result()
+        with ThreadPoolExecutor(FETCH_WORKERS) as fetchers:
+            downloads = fetchers.map(lambda frame: (frame, get_web_image(frame[1])), new_frames)
+            ## Process each frame as soon as its download completes
+            processing = [(url, processors.submit(process_frame, channel, data))
+                          for (channel, url), data in downloads if data]
+        for url, frame in processing:
+            try:
+                save_frame(url, frame.result())
+                added.add(url)
+            except Exception as error:
+                print("Error processing frame: " + url)
+                print(error)
+    return added
+
+def evict_frames(sat_images) -> None:
+    ## Drop cached frames that are no longer in any channel's window
+    keep = {frame_path(url) for _, urls in sat_images for url in urls}
+    for entry in scandir(FRAME_CACHE_DIR):
+        if entry.path not in keep:
+            remove(entry.path)
+
+def encode_animation(images: list, file_format: str) -> bytes:
+    out = BytesIO()
+    options = {"optimize": True} if file_format == "GIF" else {"lossless": True}
+    images[0].save(out, file_format, save_all=True, append_images=images[1:],
+                   duration=300, loop=0, **options)
+    return out.getvalue()
+
+def write_atomic(path: str, data: bytes) -> None:
+    partial = join(GIF_DIR, f".{getpid()}.partial")                             ## Write then rename, so the API never
+    with open(partial, "wb") as out:                                            ## serves a half-written file
+        out.write(data)
+    replace(partial, path)
+
+def webp_animation() -> bool:
+    ## Animated WebP needs libwebp's mux support; Pillow 11 dropped the webp_anim
+    ## feature as its WebP plugin always has it
+    try:
+        return bool(features.check_feature("webp_anim"))
+    except ValueError:
+        return features.check("webp")
+
+def publish(channel: str, images: list) -> dict:
+    ## Write the channel's animations and return its manifest entry
+    entry = {"updated": datetime.now().isoformat(timespec="seconds"), "frames": len(images)}
+    variants = [("gif", "GIF")] + ([("webp", "WEBP")] if webp_animation() else [])
+    for extension, file_format in variants:
+        try:
+            data = encode_animation(images, file_format)
+        except Exception as error:
+            if extension == "gif":
+                raise
+            print(f"Error encoding {extension}: {channel}")                   ## The gif is still published
+            print(error)
+            continue
+        name = f"{channel}.{sha256(data).hexdigest()[:HASH_LENGTH]}.{extension}"
+        write_atomic(join(GIF_DIR, name), data)
+        if extension == "gif":
+            write_atomic(join(GIF_DIR, f"{channel}.gif"), data)
+        entry[extension] = f"/static/{quote(name)}"
+    return entry
+
+def read_manifest() -> dict:
+    try:
+        with open(join(GIF_DIR, MANIFEST), "rb") as manifest:
+            return orjson.loads(manifest.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+def remove_stale_animations(*manifests: dict) -> None:
+    ## Drop hashed animations referenced by neither the current nor the previous manifest
+    keep = {url.rsplit("/", 1)[1] for manifest in manifests
+            for entry in manifest.values() for key, url in entry.items() if key in ("gif", "webp")}
+    for entry in scandir(GIF_DIR):
+        parts = entry.name.rsplit(".", 2)
+        if len(parts) == 3 and len(parts[1]) == HASH_LENGTH and quote(entry.name) not in keep:
+            remove(entry.path)
+
 def make_gif(sat_images):                                                       ## This builds a gif from a url
-    def get_web_image(channel, url):
-        global http
-        response = http.request("GET", url, retries=5).data
-        img = Image.open(BytesIO(response))
-        # Resize
-        if channel == "Water Vapor":                                            ## Quantize colors for compression: 32 bit for WV,
-            img = img.quantize(colors=32)
-        else:
-            img = img.quantize(colors=16)                                       ## 16 bit for all others (primarily grayscale)
-        img = img.resize((350, 350), resample=Image.LANCZOS)
-        out = BytesIO()
-        img.save(out, 'GIF')
-        out.seek(0)
-        return out                                                              ## Return the resized and compressed image
+    added = update_frame_cache(sat_images)
+    previous = read_manifest()
+    manifest = dict(previous)
     for channel, urls in sat_images:                                            ## For channel url list,
+        if channel in previous and not added.intersection(urls):                ## Nothing new since the last run
+            continue
         try:
-            images = [Image.open(get_web_image(channel, url)) for url in urls]      ## Process each linked image
-            file_out = f"/api/static/{channel}.gif"
-            # Save the animated GIF
-            images[0].save(file_out, save_all=True, append_images=images[1:],       ## Save as animated gif in the 'gifs' folder
-                        duration=300, loop=0, optimize=True)
+            images = [Image.open(frame_path(url)) for url in urls               ## Open each cached frame
+                      if exists(frame_path(url))]
+            manifest[channel] = publish(channel, images)                        ## Save as animated gif (and webp)
         except Exception as error:
             print("Error processing gif: " + channel)
             print(error)
+    if manifest != previous:
+        write_atomic(join(GIF_DIR, MANIFEST), orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        remove_stale_animations(manifest, previous)
+    evict_frames(sat_images)
 
 if __name__ == "__main__":
     print(f"{datetime.now()}\tCreating gif images")
@@ -0,0 +1,198 @@
+from os import environ, getpid, kill, makedirs, replace, scandir, unlink
+from os.path import join
+from time import perf_counter, strftime
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from random import random
+import asyncio
+import cProfile
+import orjson
+from fastapi.responses import ORJSONResponse as BaseORJSONResponse
+
+## Per-route request metrics: latency histograms, split into the phases a request
+## spends waiting for a database connection, executing its query, fetching rows,
+## serializing and sending the response, plus row and byte counts.
+## Each gunicorn worker keeps its own metrics and writes a snapshot to METRICS_DIR
+## every FLUSH_INTERVAL seconds; /metrics sums the snapshots of all live workers,
+## so it reports the same totals whichever worker answers it.
+METRICS_DIR = environ.get("METRICS_DIR", "/tmp/amrdc_api_metrics")
+FLUSH_INTERVAL = 10
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PHASES = ("db_wait", "db_execute", "fetch", "serialize", "send")
+
+## Opt-in profiling: a PROFILE_SAMPLE_RATE fraction of requests run under cProfile
+## (one at a time per worker) and those slower than PROFILE_SLOW_SECONDS are saved
+## to PROFILE_DIR. cProfile sees everything the worker's event loop runs meanwhile,
+## so a profile can include concurrent requests.
+PROFILE_SAMPLE_RATE = float(environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_SLOW_SECONDS = float(environ.get("PROFILE_SLOW_SECONDS", 1))
+PROFILE_DIR = environ.get("PROFILE_DIR", "/tmp/amrdc_api_profiles")
+
+## {(metric, labels): [bucket counts..., sum, count]} for histograms and
+## {(metric, labels): value} for counters
+HISTOGRAMS = {}
+COUNTERS = {}
+FLUSHER = None
+profiling = False
+
+## Phase timings and counts of the request being handled
+REQUEST = ContextVar("request_metrics", default=None)
+
+makedirs(METRICS_DIR, exist_ok=True)
+
+@contextmanager
+def timed(phase: str):
+    ## Add the time spent in the block to the current request's phase
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        add(phase, perf_counter() - started)
+
+def add(name: str, value: float) -> None:
+    request = REQUEST.get()
+    if request is not None:
+        request[name] = request.get(name, 0) + value
+
+def label(name: str, value: str) -> None:
+    ## Extra label for the current request: "branch" (the generate_query branch
+    ## of /aws/data) or "cache" (response cache "hit" or "miss")
+    request = REQUEST.get()
+    if request is not None:
+        request.setdefault("labels", {})[name] = value
+
+def observe(metric: str, labels: tuple, value: float) -> None:
+    histogram = HISTOGRAMS.setdefault((metric, labels), [0] * (len(BUCKETS) + 2))
+    for index, bound in enumerate(BUCKETS):
+        if value <= bound:
+            histogram[index] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+def count(metric: str, labels: tuple, value: float) -> None:
+    COUNTERS[(metric, labels)] = COUNTERS.get((metric, labels), 0) + value
+
+class ORJSONResponse(BaseORJSONResponse):
+    ## JSON response timing its rendering as the request's "serialize" phase, so the
+    ## phase is recorded for every route that returns JSON
+    def render(self, content) -> bytes:
+        with timed("serialize"):
+            return super().render(content)
+
+class MetricsMiddleware:
+    ## ASGI middleware timing every HTTP request (streamed bodies included)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global profiling
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request = {}
+        token = REQUEST.set(request)
+        status = [500]
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            else:
+                add("bytes", len(message.get("body", b"")))
+            with timed("send"):
+                await send(message)
+        profiler = None
+        if PROFILE_SAMPLE_RATE and not profiling and random() < PROFILE_SAMPLE_RATE:
+            profiling, profiler = True, cProfile.Profile()
+            profiler.enable()
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            elapsed = perf_counter() - started
+            REQUEST.reset(token)
+            endpoint = scope.get("endpoint")
+            endpoint = getattr(endpoint, "__name__", type(endpoint).__name__) if endpoint else "unmatched"
+            if profiler is not None:
+                profiler.disable()
+                profiling = False
+                if elapsed >= PROFILE_SLOW_SECONDS:
+                    save_profile(profiler, endpoint)
+            record(endpoint, str(status[0]), elapsed, request)
+
+def record(endpoint: str, status: str, elapsed: float, request: dict) -> None:
+    branch = request.get("labels", {}).get("branch", "")
+    cache = request.get("labels", {}).get("cache", "")
+    observe("amrdc_request_seconds",
+            (("endpoint", endpoint), ("branch", branch), ("cache", cache), ("status", status)), elapsed)
+    for phase in PHASES:
+        if phase in request:
+            observe("amrdc_request_phase_seconds",
+                    (("endpoint", endpoint), ("branch", branch), ("phase", phase)), request[phase])
+    count("amrdc_response_rows_total", (("endpoint", endpoint), ("branch", branch)), request.get("rows", 0))
+    count("amrdc_response_bytes_total", (("endpoint", endpoint), ("branch", branch)), request.get("bytes", 0))
+
+def save_profile(profiler: cProfile.Profile, endpoint: str) -> None:
+    makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(join(PROFILE_DIR, f"{strftime('%Y%m%dT%H%M%S')}-{endpoint}-{getpid()}.prof"))
+
+def start_flushing() -> None:
+    global FLUSHER
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            flush()
+    FLUSHER = asyncio.create_task(flush_periodically())
+
+def flush() -> None:
+    ## Write this worker's snapshot; written then renamed so readers never see half of it
+    snapshot = {"histograms": [[metric, labels, values] for (metric, labels), values in HISTOGRAMS.items()],
+                "counters": [[metric, labels, value] for (metric, labels), value in COUNTERS.items()]}
+    partial = join(METRICS_DIR, f".{getpid()}")
+    with open(partial, "wb") as out:
+        out.write(orjson.dumps(snapshot))
+    replace(partial, join(METRICS_DIR, f"{getpid()}.json"))
+
+def read_snapshots() -> list:
+    ## Snapshots of all live workers; those of exited workers are removed
+    snapshots = []
+    for entry in scandir(METRICS_DIR):
+        if entry.name.startswith("."):
+            continue
+        try:
+            kill(int(entry.name.split(".")[0]), 0)
+        except (ProcessLookupError, ValueError):
+            ## Another worker answering /metrics may have removed it first
+            with suppress(FileNotFoundError):
+                unlink(entry.path)
+            continue
+        except PermissionError:
+            pass
+        try:
+            with open(entry.path, "rb") as snapshot:
+                snapshots.append(orjson.loads(snapshot.read()))
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            continue
+    return snapshots
+
+def render() -> str:
+    ## All workers' metrics in the Prometheus text exposition format
+    flush()
+    histograms, counters = {}, {}
+    for snapshot in read_snapshots():
+        for metric, labels, values in snapshot["histograms"]:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            histograms[key] = [total + value for total, value in zip(histograms.get(key, [0] * len(values)), values)]
+        for metric, labels, value in snapshot["counters"]:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+    lines = ["# TYPE amrdc_request_seconds histogram", "# TYPE amrdc_request_phase_seconds histogram",
+             "# TYPE amrdc_response_rows_total counter", "# TYPE amrdc_response_bytes_total counter"]
+    for (metric, labels), values in sorted(histograms.items()):
+        for bound, bucket in zip(BUCKETS + ("+Inf",), values[:len(BUCKETS)] + [values[-1]]):
+            lines.append(f"{metric}_bucket{format_labels(labels + (('le', str(bound)),))} {bucket}")
+        lines.append(f"{metric}_sum{format_labels(labels)} {values[-2]}")
+        lines.append(f"{metric}_count{format_labels(labels)} {values[-1]}")
+    for (metric, labels), value in sorted(counters.items()):
+        lines.append(f"{metric}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def format_labels(labels: tuple) -> str:
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
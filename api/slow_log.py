@@ -0,0 +1,87 @@
+from os import environ, getpid
+from datetime import datetime
+from hashlib import sha1
+from time import monotonic
+import orjson
+from metrics import REQUEST
+
+## Slow query log. Queries whose execution and fetch take longer than
+## SLOW_QUERY_SECONDS (0 to disable) are appended to SLOW_QUERY_LOG as JSON lines:
+## the SQL rendered by generate_query (with its placeholders), the parameters, the
+## duration, the /aws/data branch and a summary of the query plan. The loaders log
+## slow ingest steps to the same file; dev/slow_queries.py summarizes it.
+SLOW_QUERY_LOG = environ.get("SLOW_QUERY_LOG", "/tmp/amrdc_slow_queries.jsonl")
+SLOW_QUERY_SECONDS = float(environ.get("SLOW_QUERY_SECONDS", 5))
+
+## Plans are captured in the background on another pooled connection with
+## EXPLAIN (ANALYZE, BUFFERS), which runs the query a second time. Queries slower
+## than SLOW_QUERY_ANALYZE_SECONDS and streamed downloads (whose duration is only
+## that of their first batch) get the estimated plan from a plain EXPLAIN instead.
+## SLOW_QUERY_EXPLAIN is "analyze", "plan" (never re-run queries) or "off". Each
+## query shape is explained at most once per EXPLAIN_INTERVAL seconds per worker.
+SLOW_QUERY_EXPLAIN = environ.get("SLOW_QUERY_EXPLAIN", "analyze")
+SLOW_QUERY_ANALYZE_SECONDS = float(environ.get("SLOW_QUERY_ANALYZE_SECONDS", 30))
+EXPLAIN_INTERVAL = 600
+
+## {shape: monotonic time of its last EXPLAIN}
+EXPLAINED = {}
+
+def is_slow(seconds: float) -> bool:
+    return 0 < SLOW_QUERY_SECONDS <= seconds
+
+def query_shape(sql_text: str) -> str:
+    ## Parameters are bound separately, so the SQL text identifies the query shape
+    return sha1(sql_text.encode()).hexdigest()[:12]
+
+def slow_query_entry(sql_text: str, args, seconds: float, rows: int | None, heavy: bool) -> dict:
+    request = REQUEST.get() or {}
+    return {"time": datetime.now().isoformat(timespec="seconds"), "kind": "query", "pid": getpid(),
+            "branch": request.get("labels", {}).get("branch", ""), "shape": query_shape(sql_text),
+            "seconds": round(seconds, 4), "rows": rows, "heavy": heavy, "sql": sql_text, "params": args}
+
+def explain_options(entry: dict, streamed: bool) -> str | None:
+    ## EXPLAIN options for a slow query, or None if its plan is not captured
+    if SLOW_QUERY_EXPLAIN not in ("analyze", "plan"):
+        return None
+    if monotonic() - EXPLAINED.get(entry["shape"], -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+        return None
+    EXPLAINED[entry["shape"]] = monotonic()
+    if SLOW_QUERY_EXPLAIN == "analyze" and not streamed and entry["seconds"] <= SLOW_QUERY_ANALYZE_SECONDS:
+        return "ANALYZE, BUFFERS, FORMAT JSON"
+    return "FORMAT JSON"
+
+def summarize_plan(explained: list) -> dict:
+    ## The node types (in plan order), sequential scans, sorts and buffer usage of an
+    ## EXPLAIN (FORMAT JSON) result
+    summary = {"nodes": [], "seq_scans": [], "sorts": [], "rows_removed_by_filter": 0,
+               "total_cost": explained[0]["Plan"]["Total Cost"],
+               "shared_hit_blocks": explained[0]["Plan"].get("Shared Hit Blocks"),
+               "shared_read_blocks": explained[0]["Plan"].get("Shared Read Blocks"),
+               "temp_written_blocks": explained[0]["Plan"].get("Temp Written Blocks"),
+               "planning_ms": explained[0].get("Planning Time"),
+               "execution_ms": explained[0].get("Execution Time")}
+    nodes = [explained[0]["Plan"]]
+    while nodes:
+        node = nodes.pop(0)
+        node_type = node["Node Type"]
+        if node_type not in summary["nodes"]:
+            summary["nodes"].append(node_type)
+        if node_type == "Seq Scan":
+            summary["seq_scans"].append(node["Relation Name"])
+        if "Sort Key" in node:
+            summary["sorts"].append({"node": node_type, "key": node["Sort Key"],
+                                     "method": node.get("Sort Method"),
+                                     "space_kb": node.get("Sort Space Used"),
+                                     "space_type": node.get("Sort Space Type")})
+        summary["rows_removed_by_filter"] += node.get("Rows Removed by Filter", 0) * node.get("Actual Loops", 1)
+        nodes.extend(node.get("Plans", ()))
+    return summary
+
+def write(entry: dict) -> None:
+    ## One line per entry, appended in a single write so workers never interleave
+    try:
+        with open(SLOW_QUERY_LOG, "ab") as log:
+            log.write(orjson.dumps(entry, default=str) + b"\n")
+    except OSError as error:
+        print("Error writing slow query log")
+        print(error)
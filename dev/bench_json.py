@@ -0,0 +1,86 @@
+"""JSON response benchmark for /aws/data.
+
+Compares payload size and serialization time of a 10k-row query_type=all response
+in the text ("json"), typed row ("compact") and typed column ("columnar") formats,
+rendered exactly as the API renders them (ORJSONResponse). With --url, also times
+the live endpoint of a running API instance for each format, which includes the
+database formatting cost. Start that instance with CACHE_MAX_BYTES=0 so responses
+are not served from the response cache, e.g.
+
+    python dev/bench_json.py --url http://localhost:8000 --stations Byrd
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from os.path import dirname, join
+import urllib3
+from fastapi.responses import ORJSONResponse
+
+sys.path.insert(0, join(dirname(__file__), "..", "api"))
+from api_tools import to_columns, AWS_VARIABLES
+
+ROWS = 10**4
+
+
+def synthetic_result(rows: int, typed: bool) -> dict:
+    """A query_type=all result as query_database returns it: text values with Date and
+    Time columns, or (typed) floats with an epoch-seconds ts column"""
+    start, data = 1420070400, []
+    for step in range(rows):
+        readings = [round(random.uniform(-50, 50), 1) for _ in AWS_VARIABLES]
+        readings[step % len(readings)] = None if step % 7 == 0 else readings[step % len(readings)]
+        ts = start + step * 600
+        if typed:
+            data.append(("Byrd", ts, *readings))
+        else:
+            data.append(("Byrd", time.strftime("%Y-%m-%d", time.gmtime(ts)), time.strftime("%H:%M", time.gmtime(ts)),
+                         *(None if reading is None else str(reading) for reading in readings)))
+    header = ("name", "ts") if typed else ("name", "date", "time")
+    return {"header": header + AWS_VARIABLES, "data": data}
+
+
+def best_of(repeat: int, render) -> tuple:
+    """Fastest of `repeat` renders, with the rendered body"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = render()
+        timings.append(time.perf_counter() - start)
+    return min(timings), body
+
+
+def serialization_report(repeat: int) -> list:
+    text, typed = synthetic_result(ROWS, False), synthetic_result(ROWS, True)
+    modes = (("json", lambda: ORJSONResponse(content=text).body),
+             ("compact", lambda: ORJSONResponse(content=typed).body),
+             ("columnar", lambda: ORJSONResponse(content=to_columns(typed)).body))
+    report = []
+    for mode, render in modes:
+        seconds, body = best_of(repeat, render)
+        report.append({"format": mode, "rows": ROWS, "bytes": len(body),
+                       "serialize_ms": round(seconds * 1000, 2)})
+    return report
+
+
+def live_report(url: str, stations: str, repeat: int) -> list:
+    http = urllib3.PoolManager()
+    path = f"{url}/aws/data?stations={stations}&interval=10&startdate=19000101&enddate=99991231"
+    report = []
+    for mode in ("json", "compact", "columnar"):
+        seconds, body = best_of(repeat, lambda: http.request("GET", f"{path}&format={mode}").data)
+        report.append({"format": mode, "bytes": len(body), "request_ms": round(seconds * 1000, 2)})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", help="Base URL of a running API instance to time as well")
+    parser.add_argument("--stations", default="Byrd", help="Stations for the live query")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    results = {"serialization": serialization_report(args.repeat)}
+    if args.url:
+        results["live"] = live_report(args.url.rstrip("/"), args.stations, args.repeat)
+    print(json.dumps(results, indent=2))
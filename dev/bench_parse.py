@@ -0,0 +1,121 @@
+"""Parser benchmark for the AWS 10-minute and ARGOS realtime datafiles.
+
+Times the vectorized NumPy parsers in api/db against the per-line parsers they
+replaced, on a synthetic multi-year 10-minute station file (or real datafiles
+given with --aws-file / --argos-file), and reports seconds and rows/sec as JSON.
+The legacy 10-minute parser only builds the row tuples its executemany inserted,
+while parse_datafile also renders the binary COPY batches, so the 10-minute
+speedup understates the gain once the INSERTs are counted.
+aws_db and realtime_db connect to Postgres on import, so run this with the
+POSTGRES_* environment set, e.g.
+
+    python dev/bench_parse.py --years 10
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), "..", "api", "db"))
+import aws_db
+import realtime_db
+
+def legacy_aws_parse(name: str, data: bytes) -> int:
+    """The per-line 10-minute parser the loader used before parse_datafile, copied
+    from its process_datapoint/process_datafile less the download: a tuple of
+    strings per line, ready for executemany. The INSERTs themselves are not timed."""
+    def process_datapoint(name: str, line: str) -> tuple:
+        try:
+            row = line.split()
+            formatted_date = f"{row[0]}-{row[2]}-{row[3]}"
+            params = (name,formatted_date) + tuple(row[4:])
+            return params
+        except Exception as error:
+            print(f"Error processing datapoint: {name}\n{line}")
+            print(error)
+    data = data.decode('utf-8').strip().split('\n')[2:]
+    formatted_datafile = tuple(process_datapoint(name, line) for line in data)
+    return len(formatted_datafile)
+
+
+def legacy_argos_parse(station_name: str, region: str, data: bytes) -> int:
+    """The per-line ARGOS parser: split every line twice, strptime every date and time"""
+    lines = data.decode('utf-8').strip().split('\n')
+    table = [line.split()[1:] for line in lines if len(line.split()) == 10][2:]
+    rows = []
+    for date_str, time_str, temp, press, wind_spd, wind_dir, hum, _, _ in table:
+        rows.append({"station_name": station_name,
+                     "date": datetime.strptime(date_str, '%Y%j').date(),
+                     "time": datetime.strptime(time_str, '%H%M%S').time(),
+                     "temperature": float(temp), "pressure": float(press),
+                     "wind_speed": float(wind_spd), "wind_direction": int(float(wind_dir)),
+                     "humidity": float(hum), "region": region})
+    return len(rows)
+
+
+def synthetic_aws_file(years: int) -> bytes:
+    """A 10-minute datafile covering `years` years, with 444 sentinels mixed in"""
+    lines = ["Year: 2000  Month: 01  ID: 8903  ARGOS: 8903  Name: Byrd",
+             "Lat: 80.00S  Lon: 119.40W  Elev: 1530m"]
+    start = datetime(2000, 1, 1)
+    for step in range(int(years * 365.25 * 144)):
+        ts = start + timedelta(minutes=10 * step)
+        readings = [random.uniform(-50, 0), random.uniform(700, 900), random.uniform(0, 20),
+                    random.uniform(0, 360), random.uniform(20, 100), random.uniform(-2, 2)]
+        readings[step % 6] = 444.0 if step % 7 == 0 else readings[step % 6]
+        lines.append(f"{ts.year} {ts.timetuple().tm_yday:3d} {ts.month:2d} {ts.day:2d} {ts:%H%M} "
+                     + " ".join(f"{reading:7.1f}" for reading in readings))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def synthetic_argos_file(days: int) -> bytes:
+    """An hourly ARGOS datafile covering `days` days"""
+    lines = ["8903 ARGOS datafile header line with ten columns x y", "id date time t p ws wd rh a b"]
+    start = datetime(2024, 1, 1)
+    for step in range(days * 24):
+        ts = start + timedelta(hours=step)
+        lines.append(f"8903 {ts:%Y%j} {ts:%H%M%S} {random.uniform(-50, 0):.1f} {random.uniform(700, 900):.1f} "
+                     f"{random.uniform(0, 20):.1f} {random.randint(0, 360)} {random.uniform(20, 100):.1f} 0 0")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def best_of(repeat: int, parse, *args) -> tuple:
+    """Fastest of `repeat` runs, with the row count of the last run"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = parse(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), rows
+
+
+def compare(label: str, repeat: int, legacy: tuple, vectorized: tuple) -> dict:
+    (legacy_seconds, legacy_rows), (new_seconds, new_rows) = best_of(repeat, *legacy), best_of(repeat, *vectorized)
+    return {"file": label, "rows": new_rows, "legacy_rows": legacy_rows,
+            "legacy_seconds": round(legacy_seconds, 4), "numpy_seconds": round(new_seconds, 4),
+            "legacy_rows_per_sec": round(legacy_rows / legacy_seconds),
+            "numpy_rows_per_sec": round(new_rows / new_seconds),
+            "speedup": round(legacy_seconds / new_seconds, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--years", type=int, default=5, help="Years in the synthetic 10-minute file")
+    parser.add_argument("--aws-file", help="Benchmark a real 10-minute datafile instead")
+    parser.add_argument("--argos-file", help="Benchmark a real ARGOS datafile instead")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    aws_data = open(args.aws_file, "rb").read() if args.aws_file else synthetic_aws_file(args.years)
+    argos_data = open(args.argos_file, "rb").read() if args.argos_file else synthetic_argos_file(14)
+    reports = [
+        compare(args.aws_file or f"synthetic {args.years}-year 10min", args.repeat,
+                (legacy_aws_parse, "Byrd", aws_data),
+                (lambda data: aws_db.parse_datafile(1, "Byrd", data)[0], aws_data)),
+        compare(args.argos_file or "synthetic 14-day ARGOS", args.repeat,
+                (legacy_argos_parse, "Byrd", "West Antarctica", argos_data),
+                (lambda data: len(realtime_db.process_datafile("Byrd", "West Antarctica", data)), argos_data)),
+    ]
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,285 @@
+"""Reproducible benchmark of the AMRDC AWS API on a synthetic dataset.
+
+`generate` fills a local Postgres (the POSTGRES_* environment) with a synthetic
+multi-station, multi-decade aws_10min and two weeks of hourly aws_realtime rows,
+using the loader's own COPY, rollup and catalog code. It replaces the AWS and
+realtime data in that database, so it requires --replace-data.
+
+`run` starts the API (one uvicorn worker, response cache off) against that database,
+times a fixed workload covering every generate_query branch (all/max/min/mean by
+station/year/month/day grouping, for a few and for all stations) plus the list and
+realtime endpoints, then measures throughput under concurrent load and the server's
+memory. Results are written as JSON so runs can be compared across commits with
+`compare`, e.g.
+
+    python dev/benchmark.py generate --stations 10 --years 20 --replace-data
+    python dev/benchmark.py run --output before.json
+    git checkout my-branch && python dev/benchmark.py run --output after.json
+    python dev/benchmark.py compare before.json after.json
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import cycle
+from os import environ
+from os.path import abspath, dirname, join
+from urllib.parse import quote
+import numpy as np
+import urllib3
+
+sys.path.insert(0, join(dirname(abspath(__file__)), "..", "api", "db"))
+from load_test import percentile
+
+ROOT = join(dirname(abspath(__file__)), "..")
+PORT = 8099
+GROUPINGS = ("station", "year", "month", "day")
+FEW_STATIONS = 3
+REALTIME_DAYS = 14
+
+
+def station_names(count: int) -> list:
+    """Real station names (spaces and parentheses included), numbered past the ARGOS list"""
+    from realtime_db import ARGOS
+    names = [name for _, name, _ in ARGOS]
+    return [names[index % len(names)] + (f" {index // len(names)}" if index >= len(names) else "")
+            for index in range(count)]
+
+
+def synthetic_columns(rng: np.random.Generator, first_year: int, last_year: int) -> dict:
+    """10-minute readings with a seasonal and daily cycle, noise and 1% missing values,
+    as aws_db.process_datafile returns them"""
+    from aws_db import INTERVALS, VARIABLES
+    ts = np.arange(np.datetime64(f"{first_year}-01-01T00:00"), np.datetime64(f"{last_year + 1}-01-01T00:00"),
+                   np.timedelta64(10, "m"))
+    day_of_year = (ts - ts.astype("M8[Y]")).astype("m8[D]").astype(np.float32)
+    minute = (ts - ts.astype("M8[D]")).astype(np.int64)
+    hour_minute = minute // 60 * 100 + minute % 60
+    interval_bucket = np.zeros(len(ts), dtype=np.int16)
+    for interval in reversed(INTERVALS):
+        interval_bucket[hour_minute % interval == 0] = interval
+    season = np.cos(2 * np.pi * day_of_year / 365.25).astype(np.float32)
+    daily = np.sin(2 * np.pi * minute / 1440).astype(np.float32)
+    base = {"temperature": (-30 + 15 * season + 3 * daily, 2), "pressure": (700 + 10 * season, 3),
+            "wind_speed": (8 - 2 * season, 3), "wind_direction": (180, 90),
+            "humidity": (70 + 5 * daily, 10), "delta_t": (0, 1)}
+    columns = {"ts": ts, "interval_bucket": interval_bucket}
+    for variable in VARIABLES:
+        mean, spread = base[variable]
+        values = (mean + rng.normal(0, spread, len(ts))).astype(np.float32)
+        values[rng.random(len(ts)) < 0.01] = np.nan
+        columns[variable] = values
+    return columns
+
+
+def generate(stations: int, years: int, last_year: int, seed: int) -> dict:
+    from config import postgres
+    import aws_db
+    import realtime_db
+    rng = np.random.default_rng(seed)
+    names = station_names(stations)
+    rows = 0
+    started = time.perf_counter()
+    with postgres:
+        db = postgres.cursor()
+        db.execute("DROP TABLE IF EXISTS aws_10min CASCADE")
+        aws_db.create_aws_table(db, "aws_10min")
+        aws_db.create_station_table(db)
+        aws_db.create_manifest_table(db)
+        db.execute("DELETE FROM aws_10min_manifest")
+        aws_db.create_partitions(db, "aws_10min", last_year - years + 1, last_year)
+        for index, name in enumerate(names):
+            ## Stagger station start years so coverage differs between stations
+            first_year = last_year - years + 1 + index % max(1, years // 4)
+            columns = synthetic_columns(rng, first_year, last_year)
+            batches = [aws_db.render_copy(aws_db.get_station_id(db, name),
+                                          {column: values[offset:offset + aws_db.COPY_BATCH_SIZE]
+                                           for column, values in columns.items()})
+                       for offset in range(0, len(columns["ts"]), aws_db.COPY_BATCH_SIZE)]
+            aws_db.copy_batches(db, "aws_10min", batches)
+            rows += len(columns["ts"])
+            print(f"{name}: {first_year}-{last_year}, {len(columns['ts'])} rows", file=sys.stderr)
+        aws_db.create_aws_indexes(db)
+        aws_db.build_rollup_table(db)
+        aws_db.build_catalog_table(db)
+        db.execute("INSERT INTO aws_10min_last_update (last_update) VALUES (NOW()::timestamp)")
+        db.execute("ANALYZE")
+
+        realtime_db.create_realtime_tables(db)
+        db.execute("DELETE FROM aws_realtime")
+        db.execute("DELETE FROM aws_realtime_aggregate")
+        now = datetime.now().replace(minute=0, second=0, microsecond=0)
+        observations = [{"station_name": name, "region": region, "date": moment.date(), "time": moment.time(),
+                         **{reading: round(float(rng.normal(mean, 5)), 1) for reading, mean in
+                            zip(realtime_db.READINGS, (-25, 700, 8, 180, 70))}}
+                        for _, name, region in realtime_db.ARGOS
+                        for moment in (now - timedelta(hours=hour) for hour in range(REALTIME_DAYS * 24))]
+        realtime_db.update_aggregates(db, [row[:-1] for row in realtime_db.upsert_observations(db, observations)])
+        db.execute("INSERT INTO aws_realtime_last_update (last_update) VALUES (NOW()::timestamp)")
+    return {"stations": stations, "years": years, "last_year": last_year, "seed": seed,
+            "aws_rows": rows, "realtime_rows": len(observations),
+            "seconds": round(time.perf_counter() - started, 1)}
+
+
+def workload(stations: list, years: list) -> list:
+    """(label, path) for every generate_query branch and the list and realtime endpoints"""
+    few, everyone = (",".join(quote(station) for station in selection)
+                     for selection in (stations[:FEW_STATIONS], stations))
+    year = f"startdate={years[-1]}0101&enddate={years[-1]}1231"
+    queries = [
+        ("all few 1y 10min", f"/aws/data?stations={few}&interval=10&{year}"),
+        ("all few 3h", f"/aws/data?stations={few}&interval=300"),
+        ("all every 1m 10min", f"/aws/data?stations={everyone}&interval=10"
+                               f"&startdate={years[-1]}0101&enddate={years[-1]}0131"),
+        ("all few 1y compact", f"/aws/data?stations={few}&interval=10&{year}&format=compact"),
+        ("all few 1y csv", f"/aws/data?stations={few}&interval=10&{year}&download=true"),
+    ]
+    for query_type in ("max", "min", "mean"):
+        for grouping in GROUPINGS:
+            for label, selection in (("few", few), ("all", "all")):
+                queries.append((f"{query_type} {grouping} {label}",
+                                f"/aws/data?query_type={query_type}&stations={selection}"
+                                f"&variable=temperature&grouping={grouping}"))
+    queries += [
+        ("list", "/aws/list"),
+        ("list stations", f"/aws/list/stations={few}"),
+        ("list years", f"/aws/list/years={','.join(str(year) for year in years[-3:])}"),
+        ("realtime station", "/realtime/station/Byrd"),
+        ("realtime all", "/realtime/station/all"),
+        ("realtime list", "/realtime/station_list"),
+        ("realtime maxmin", "/realtime/maxmin/temperature"),
+        ("realtime maxmin month", "/realtime/maxmin/temperature?window=month"),
+    ]
+    return queries
+
+
+def time_queries(http: urllib3.PoolManager, base_url: str, queries: list, repeat: int) -> dict:
+    results = {}
+    for label, path in queries:
+        latencies, statuses, size = [], set(), 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = http.request("GET", base_url + path, retries=False, timeout=600)
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses.add(response.status)
+            size = len(response.data)
+        latencies.sort()
+        results[label] = {"path": path, "status": sorted(statuses), "bytes": size,
+                          "p50_ms": round(percentile(latencies, 50), 2),
+                          "p90_ms": round(percentile(latencies, 90), 2),
+                          "p99_ms": round(percentile(latencies, 99), 2),
+                          "max_ms": round(latencies[-1], 2)}
+    return results
+
+
+def throughput(base_url: str, queries: list, concurrency: int, duration: float) -> dict:
+    """Requests/sec with `concurrency` clients cycling through the workload"""
+    http = urllib3.PoolManager(maxsize=concurrency)
+    deadline = time.perf_counter() + duration
+    def client(offset: int) -> list:
+        statuses = []
+        for _, path in cycle(queries[offset:] + queries[:offset]):
+            if time.perf_counter() > deadline:
+                break
+            statuses.append(http.request("GET", base_url + path, retries=False, timeout=600).status)
+        return statuses
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as clients:
+        statuses = [status for results in clients.map(client, range(concurrency)) for status in results]
+    elapsed = time.perf_counter() - started
+    return {"concurrency": concurrency, "requests": len(statuses),
+            "errors": sum(1 for status in statuses if status != 200),
+            "requests_per_sec": round(len(statuses) / elapsed, 1)}
+
+
+def memory(pid: int) -> dict:
+    """Current and peak resident memory of a process, in MB (Linux)"""
+    with open(f"/proc/{pid}/status") as status:
+        fields = dict(line.split(":", 1) for line in status)
+    return {"rss_mb": round(int(fields["VmRSS"].split()[0]) / 1024, 1),
+            "peak_rss_mb": round(int(fields["VmHWM"].split()[0]) / 1024, 1)}
+
+
+def run(repeat: int, concurrency: int, duration: float, cache: bool) -> dict:
+    env = dict(environ, CACHE_MAX_BYTES=environ.get("CACHE_MAX_BYTES", "134217728") if cache else "0")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "api:app", "--port", str(PORT)],
+                              cwd=join(ROOT, "api"), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://localhost:{PORT}"
+    http = urllib3.PoolManager()
+    try:
+        for _ in range(60):
+            try:
+                http.request("GET", f"{base_url}/test", retries=False)
+                break
+            except urllib3.exceptions.HTTPError:
+                time.sleep(0.5)
+        listing = json.loads(http.request("GET", f"{base_url}/aws/list").data)
+        stations = [station for (station,) in listing["stations"]]
+        years = [year for (year,) in listing["years"]]
+        queries = workload(stations, years)
+        started_memory = memory(server.pid)
+        return {
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                     capture_output=True, text=True).stdout.strip(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "dataset": {"stations": len(stations), "first_year": years[0], "last_year": years[-1]},
+            "cache": cache,
+            "queries": time_queries(http, base_url, queries, repeat),
+            "throughput": throughput(base_url, queries, concurrency, duration),
+            "memory": {"startup": started_memory, "end": memory(server.pid)},
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(before: dict, after: dict) -> list:
+    """p50 latency of each query in two runs, with the after/before ratio"""
+    rows = []
+    for label, result in after["queries"].items():
+        previous = before["queries"].get(label)
+        if previous:
+            rows.append({"query": label, "before_p50_ms": previous["p50_ms"], "after_p50_ms": result["p50_ms"],
+                         "ratio": round(result["p50_ms"] / previous["p50_ms"], 2) if previous["p50_ms"] else None})
+    rows.append({"query": "throughput (req/s)", "before": before["throughput"]["requests_per_sec"],
+                 "after": after["throughput"]["requests_per_sec"]})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="Load a synthetic dataset into Postgres")
+    generate_parser.add_argument("--stations", type=int, default=10)
+    generate_parser.add_argument("--years", type=int, default=10)
+    generate_parser.add_argument("--last-year", type=int, default=datetime.now().year - 1)
+    generate_parser.add_argument("--seed", type=int, default=1)
+    generate_parser.add_argument("--replace-data", action="store_true",
+                                 help="Confirm that the database's AWS and realtime data may be replaced")
+    run_parser = commands.add_parser("run", help="Benchmark the API on the loaded dataset")
+    run_parser.add_argument("--repeat", type=int, default=5, help="Timed requests per query")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=20.0, help="Seconds of concurrent load")
+    run_parser.add_argument("--cache", action="store_true", help="Keep the response cache on")
+    run_parser.add_argument("--output", help="Write results to this JSON file")
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args()
+    if args.command == "generate":
+        if not args.replace_data:
+            parser.error("generate replaces the AWS and realtime tables; pass --replace-data to confirm")
+        results = generate(args.stations, args.years, args.last_year, args.seed)
+    elif args.command == "run":
+        results = run(args.repeat, args.concurrency, args.duration, args.cache)
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(results, output, indent=2)
+    else:
+        with open(args.before) as before, open(args.after) as after:
+            results = compare(json.load(before), json.load(after))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,80 @@
+"""Load benchmark for the AMRDC AWS API.
+
+Runs a mixed workload of slow /aws/data aggregates and fast /realtime lookups
+against one or more running API instances and reports requests/sec and latency
+percentiles per endpoint. To compare the sync and async database paths, start
+the baseline build and the current build on different ports, e.g.
+
+    python dev/load_test.py http://localhost:8001 http://localhost:8000 --duration 60
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle
+import urllib3
+
+## (label, path) pairs: one heavy aggregate per few cheap lookups, mirroring
+## dashboards polling /realtime while analysts run /aws/data queries.
+WORKLOAD = (
+    ("aws_max_all_day", "/aws/data?query_type=max&stations=all&variable=temperature&grouping=day"),
+    ("realtime_station", "/realtime/station/Byrd"),
+    ("realtime_station_list", "/realtime/station_list"),
+    ("aws_all_byrd", "/aws/data?stations=Byrd&interval=300&startdate=20200101&enddate=20201231"),
+    ("realtime_station", "/realtime/station/Nico"),
+    ("realtime_maxmin", "/realtime/maxmin/temperature"),
+)
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of a sorted list of samples."""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, max(0, round(pct / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def run(base_url: str, concurrency: int, duration: float) -> dict:
+    """Hammer base_url with the workload for `duration` seconds."""
+    http = urllib3.PoolManager(maxsize=concurrency)
+    deadline = time.perf_counter() + duration
+    def worker(offset: int) -> list:
+        results = []
+        workload = cycle(WORKLOAD[offset % len(WORKLOAD):] + WORKLOAD[:offset % len(WORKLOAD)])
+        while time.perf_counter() < deadline:
+            label, path = next(workload)
+            start = time.perf_counter()
+            try:
+                status = http.request("GET", base_url + path, retries=False, timeout=120).status
+            except Exception:
+                status = None
+            results.append((label, status, time.perf_counter() - start))
+        return results
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = [sample for results in executor.map(worker, range(concurrency))
+                   for sample in results]
+    elapsed = time.perf_counter() - started
+
+    report = {"url": base_url, "requests": len(samples),
+              "errors": sum(1 for _, status, _ in samples if status != 200),
+              "requests_per_sec": round(len(samples) / elapsed, 1), "endpoints": {}}
+    for label in dict.fromkeys(label for label, _ in WORKLOAD):
+        latencies = sorted(seconds * 1000 for name, _, seconds in samples if name == label)
+        report["endpoints"][label] = {
+            "requests": len(latencies),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "max_ms": round(latencies[-1], 1) if latencies else 0.0,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("urls", nargs="+", help="Base URL(s) of running API instances")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per instance")
+    args = parser.parse_args()
+    reports = [run(url.rstrip("/"), args.concurrency, args.duration) for url in args.urls]
+    print(json.dumps(reports, indent=2))
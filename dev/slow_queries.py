@@ -0,0 +1,132 @@
+"""Summarize the AMRDC AWS API slow query log.
+
+The API appends queries slower than SLOW_QUERY_SECONDS to SLOW_QUERY_LOG (see
+api/slow_log.py) with their SQL, parameters, duration and a summary of their
+EXPLAIN plan; the loaders log slow ingest steps to the same file. `queries` groups
+the logged queries by shape (their SQL text, parameters aside) and lists the worst
+shapes with their /aws/data branches, latency and plan: node types, sequential
+scans, sorts (and whether they spilled to disk) and rows discarded by filters.
+`show` prints the slowest logged instance of one shape, with its full SQL,
+parameters and plan. `ingest` lists the slowest loader steps, e.g.
+
+    python dev/slow_queries.py queries --top 10
+    python dev/slow_queries.py show 3f2a9c0d81b4
+    python dev/slow_queries.py ingest
+"""
+import argparse
+import json
+import re
+from os import environ
+from load_test import percentile
+
+## Yearly partitions of aws_10min (aws_10min_y2019, ...) are reported as one table
+PARTITION = re.compile(r"_y\d{4}$")
+
+
+def read_log(path: str, kind: str) -> list:
+    """Entries of one kind ("query" or "ingest"); unreadable lines are skipped."""
+    entries = []
+    with open(path) as log:
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("kind") == kind:
+                entries.append(entry)
+    return entries
+
+
+def summarize_shapes(entries: list) -> list:
+    """Per-shape counts, latencies and plan features, worst total time first."""
+    shapes = {}
+    for entry in entries:
+        shapes.setdefault(entry["shape"], []).append(entry)
+    summaries = []
+    for shape, instances in shapes.items():
+        seconds = sorted(instance["seconds"] for instance in instances)
+        plans = [instance["plan_summary"] for instance in instances if instance.get("plan_summary")]
+        summaries.append({
+            "shape": shape,
+            "count": len(instances),
+            "total_s": round(sum(seconds), 3),
+            "p50_s": round(percentile(seconds, 50), 3),
+            "max_s": round(seconds[-1], 3),
+            "rows": max((instance["rows"] for instance in instances if instance.get("rows") is not None),
+                        default=None),
+            "branches": sorted({instance.get("branch") or "-" for instance in instances}),
+            "nodes": list(dict.fromkeys(node for plan in plans for node in plan["nodes"])),
+            "seq_scans": sorted({PARTITION.sub("", table) for plan in plans for table in plan["seq_scans"]}),
+            "sorts": sorted({f"{sort['node']} {sort['method'] or 'planned'}"
+                             + (" (disk)" if sort.get("space_type") == "Disk" else "")
+                             for plan in plans for sort in plan["sorts"]}),
+            "rows_removed_by_filter": max((plan["rows_removed_by_filter"] for plan in plans), default=None),
+            "sql": " ".join(instances[0]["sql"].split()),
+        })
+    summaries.sort(key=lambda summary: summary["total_s"], reverse=True)
+    return summaries
+
+
+def print_shapes(summaries: list, top: int) -> None:
+    for summary in summaries[:top]:
+        print(f"{summary['shape']}  {summary['count']}x  total {summary['total_s']}s  "
+              f"p50 {summary['p50_s']}s  max {summary['max_s']}s  rows {summary['rows']}")
+        print(f"  branches: {', '.join(summary['branches'])}")
+        if summary["nodes"]:
+            print(f"  plan: {' > '.join(summary['nodes'])}")
+            print(f"  seq scans: {', '.join(summary['seq_scans']) or '-'}   "
+                  f"sorts: {', '.join(summary['sorts']) or '-'}   "
+                  f"rows removed by filter: {summary['rows_removed_by_filter']}")
+        else:
+            print("  plan: not captured")
+        print(f"  sql: {summary['sql'][:200]}{'...' if len(summary['sql']) > 200 else ''}")
+        print()
+
+
+def show_shape(entries: list, shape: str) -> None:
+    instances = [entry for entry in entries if entry["shape"].startswith(shape)]
+    if not instances:
+        print(f"No logged queries of shape {shape}")
+        return
+    explained = [entry for entry in instances if entry.get("plan")]
+    worst = max(explained or instances, key=lambda entry: entry["seconds"])
+    print(f"{worst['time']}  {worst['seconds']}s  rows {worst.get('rows')}  branch {worst.get('branch') or '-'}")
+    print(worst["sql"])
+    print(f"params: {json.dumps(worst['params'])}")
+    if worst.get("plan"):
+        print(f"plan ({'EXPLAIN ANALYZE' if worst.get('analyzed') else 'EXPLAIN'}):")
+        print(json.dumps(worst["plan"], indent=2))
+
+
+def print_ingest(entries: list, top: int) -> None:
+    for entry in sorted(entries, key=lambda entry: entry["seconds"], reverse=True)[:top]:
+        details = {key: value for key, value in entry.items()
+                   if key not in ("time", "kind", "pid", "loader", "step", "seconds")}
+        print(f"{entry['time']}  {entry['loader']} {entry['step']}  {entry['seconds']}s  "
+              + "  ".join(f"{key} {value}" for key, value in details.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--log", default=environ.get("SLOW_QUERY_LOG", "/tmp/amrdc_slow_queries.jsonl"),
+                        help="Slow query log (default: SLOW_QUERY_LOG or /tmp/amrdc_slow_queries.jsonl)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    queries_parser = commands.add_parser("queries", help="Worst query shapes by total time")
+    queries_parser.add_argument("--top", type=int, default=10)
+    queries_parser.add_argument("--json", action="store_true", help="Print the summaries as JSON")
+    show_parser = commands.add_parser("show", help="Slowest instance of a query shape, with its plan")
+    show_parser.add_argument("shape", help="Shape id (or a prefix of it)")
+    ingest_parser = commands.add_parser("ingest", help="Slowest loader steps")
+    ingest_parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "queries":
+        summaries = summarize_shapes(read_log(args.log, "query"))
+        if args.json:
+            print(json.dumps(summaries[:args.top], indent=2))
+        else:
+            print_shapes(summaries, args.top)
+    elif args.command == "show":
+        show_shape(read_log(args.log, "query"), args.shape)
+    else:
+        print_ingest(read_log(args.log, "ingest"), args.top)
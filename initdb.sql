@@ -1,16 +1,22 @@
 ALTER SYSTEM SET work_mem = '128MB';
 
+CREATE TABLE IF NOT EXISTS aws_station (
+    station_id SMALLSERIAL PRIMARY KEY,
+    station_name VARCHAR(18) UNIQUE
+);
+
+-- Partitioned by year; the loader creates aws_10min_y<year> partitions as needed
 CREATE TABLE IF NOT EXISTS aws_10min (
-    station_name VARCHAR(18),
-    date DATE,
-    time TIME,
+    station_id SMALLINT,
+    ts TIMESTAMP,
+    interval_bucket SMALLINT,
     temperature REAL,
     pressure REAL,
     wind_speed REAL,
     wind_direction REAL,
     humidity REAL,
     delta_t REAL
-);
+) PARTITION BY RANGE (ts);
 
 CREATE TABLE IF NOT EXISTS aws_10min_last_update (
     last_update TIMESTAMP
@@ -27,3 +33,61 @@ CREATE TABLE IF NOT EXISTS aws_realtime (
     humidity REAL,
     region VARCHAR(24)
 );
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_realtime_station_ts ON aws_realtime (station_name, date, time);
+
+CREATE TABLE IF NOT EXISTS aws_realtime_fetch (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT
+);
+
+CREATE TABLE IF NOT EXISTS aws_realtime_aggregate (
+    window_type VARCHAR(5),
+    period DATE,
+    station_name VARCHAR(18),
+    variable VARCHAR(14),
+    max_value REAL,
+    max_date DATE,
+    max_time TIME,
+    min_value REAL,
+    min_date DATE,
+    min_time TIME,
+    PRIMARY KEY (window_type, period, station_name, variable)
+);
+
+CREATE TABLE IF NOT EXISTS aws_realtime_last_update (
+    last_update TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS aws_10min_rollup (
+    period_type VARCHAR(5),
+    station_id SMALLINT,
+    period DATE,
+    variable VARCHAR(14),
+    max_value REAL,
+    max_ts TIMESTAMP,
+    min_value REAL,
+    min_ts TIMESTAMP,
+    total DOUBLE PRECISION,
+    count INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS aws_10min_catalog (
+    station_id SMALLINT,
+    year SMALLINT,
+    rows INTEGER,
+    first_ts TIMESTAMP,
+    last_ts TIMESTAMP,
+    PRIMARY KEY (station_id, year)
+);
+
+CREATE TABLE IF NOT EXISTS aws_10min_manifest (
+    url TEXT PRIMARY KEY,
+    station_name VARCHAR(18),
+    last_modified TIMESTAMP,
+    size BIGINT,
+    hash CHAR(32),
+    first_date DATE,
+    last_date DATE
+);